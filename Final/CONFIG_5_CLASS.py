@@ -8,12 +8,34 @@ NUM_TRACKS = 5
 NUM_CLASSES = 5
 BATCH_SIZE = 32
 NUM_LAYERS = 1
+BATCHED_TRACKS = False #run each private per-track layer once for all tracks with stacked weights, see track_layers
+
+#DATA PARAMETERS (filters need the phrase index written by data_parser)
+MIN_PHRASE_NOTES = 0 #notes (onsets, a held note counts once) a phrase needs over all tracks
+MAX_EMPTY_BARS = None
+PHRASE_CACHE_BYTES = 0 #off, set a byte budget (e.g. 2**30) to keep decoded phrases bit-packed in memory between epochs, split between data-parallel workers
+PREFETCH_BATCHES = 4 #batches decoded ahead of the training step
+PREFETCH_WORKERS = 4
+INPUT_PIPELINE = 'feed_dict' #'feed_dict' feeds prefetched numpy batches, 'tf_data' reads them through tf_input
+TF_DATA_PARALLEL_CALLS = 4
+TF_DATA_SHUFFLE_BUFFER = 1024
+GENRE_WEIGHTS = 'balanced' #genre mix of real data batches: 'balanced', 'proportional' to phrase counts or one weight per GENRE_LIST entry
+SAMPLER_SEED = None #seed of the genre sampler, None draws a new order every run
+METRICS_FLUSH_STEPS = 100 #Model.csv rows are buffered and written in the background every this many steps
+METRICS_FLUSH_SECONDS = 30 #or after this many seconds
+CHECKPOINT_KEEP_LAST = 3 #newest checkpoints kept on disk
+CHECKPOINT_KEEP_BEST = 3 #best checkpoints kept on disk by the metric of the trainer (classifier accuracy)
+CHECKPOINT_BEST_MODE = 'max' #'max' or 'min', whether a higher metric is better
+CHECKPOINT_EVERY_STEPS = 1000 #GAN steps between resumable checkpoints, on top of the one every epoch
+PROFILE_TRACE_EVERY = 500 #GAN steps between FULL_TRACE Chrome traces when profiling, 0 only times the phases
+PROFILE_WINDOW = 1000 #latest steps the profile percentiles are taken over
 
 #HYPER PARAMETERS FOR MODEL ARCHITECTURE
 LATENT_SIZE = 128
 SLOPE_TENSOR = 1.1
 
 #CLASSIFIER TRAINING HYPER PARAMETERS
+STEPS_PER_RUN = 1 #classifier optimizer steps per sess.run, run in a tf.while_loop when above 1
 CLASSIFIER_EPOCHS = 20
 LEARNING_RATE = 0.0001
 GENRE_LIST = ['dance','pop','alternative', 'rock', 'classic']
@@ -22,3 +44,15 @@ GENRE_LIST = ['dance','pop','alternative', 'rock', 'classic']
 RESIDUAL_LAYERS = 3
 LABEL_SMOOTHING = 0
 CONFIDENCE_PENTALTY = 0.0
+
+#DATA PARALLEL TRAINING (worker processes on one machine, 1 trains in a single process)
+DATA_PARALLEL_WORKERS = 1
+
+#GENERATION (generate.py)
+GENERATION_BATCH_SIZE = 256 #phrases per sess.run of the generator-only graph
+GENERATION_BINARIZE = 'round' #'round' like the songs rendered in training or 'bernoulli' to sample every cell
+GENERATION_CACHE_BYTES = 2**32 #generation_cache disk budget for phrases and their rendered files
+SOUNDFONT_PATH = 'FluidR3_GM.sf2' #FluidSynth soundfont for WAV rendering
+SERVER_PORT = 8765 #serve.py, local generation server
+SERVER_MAX_BATCH = 256 #phrases of concurrent requests coalesced into one sess.run
+SERVER_MAX_DELAY_MS = 10 #longest a request waits for its batch to fill
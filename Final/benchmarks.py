@@ -0,0 +1,262 @@
+import os, sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import importlib
+from os.path import join
+from datetime import datetime
+import numpy as np
+from CONFIG import *
+import data_parser
+
+##Benchmarks on synthetic data that run on CPU, from the Final directory:
+##  python benchmarks.py run -o results.json [-s slicing parse get_batch convert model] [-b 1 16 32]
+##  python benchmarks.py compare baseline.json results.json [-t 0.1]
+##
+##run times every suite asked for and writes one JSON file: the machine and library versions next to one result
+##per benchmark (value, unit and whether higher is better). Every benchmark uses fixed seeds, so two runs on the same
+##machine measure the same work. compare lines up the benchmarks of two such files and flags every one that got
+##worse by more than the threshold (a fraction, 0.1 is 10%); it exits with 1 when something regressed.
+##The model suite times forward and forward+backward sess.runs of Generator, Discriminator and Classifier at each batch
+##size, with the architecture (NUM_CLASSES, LATENT_SIZE) of every CONFIG variant and both private track layouts.
+
+SUITES = ['slicing', 'parse', 'get_batch', 'convert', 'model']
+CONFIG_VARIANTS = ['CONFIG', 'CONFIG_5_CLASS']
+MODELS = ['generator', 'discriminator', 'classifier']
+TRACK_LAYOUTS = {'per_track': False, 'batched': True}
+PARSE_FORMATS = ['npz', 'sparse', 'shards']
+HIGHER_IS_BETTER = {'phrases/sec': True, 'ms': False}
+
+
+def synthetic_song(num_phrases, density=0.01, seed=0):
+    #random sparse pianorolls in the LPD layout (one (time, 128) bool array per track)
+    rng = np.random.RandomState(seed)
+    return [rng.rand(num_phrases*data_parser.BEATS_PER_SET, TOTAL_PIANOROLL_NOTES) < density for track in range(NUM_TRACKS)]
+
+def synthetic_phrases(num_phrases, density=0.01, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.rand(num_phrases, NUM_BARS, BEATS_PER_BAR, NUM_NOTES, NUM_TRACKS) < density
+
+def write_synthetic_songs(genres_directory, songs_per_genre, num_phrases):
+    #a folder of genre folders of LPD style multitrack files, like the ones data_parser reads
+    import pypianoroll
+    for genre_id, genre in enumerate(GENRE_LIST):
+        os.makedirs(join(genres_directory, genre), exist_ok=True)
+        for song in range(songs_per_genre):
+            pianorolls = synthetic_song(num_phrases, seed=genre_id*songs_per_genre + song)
+            tracks = [pypianoroll.Track(pianoroll=pianoroll, name=str(track)) for track, pianoroll in enumerate(pianorolls)]
+            pypianoroll.save(join(genres_directory, genre, genre + "_song_" + str(song) + ".npz"), pypianoroll.Multitrack(tracks=tracks, tempo=120.0, beat_resolution=24))
+
+def time_call(function, repeats):
+    start = time.perf_counter()
+    for i in range(repeats):
+        function()
+    return (time.perf_counter() - start)/repeats
+
+def time_calls(function, repeats, warmup=1):
+    #seconds of every call after the warmup calls
+    for i in range(warmup):
+        function()
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return np.asarray(times)
+
+def record(results, name, value, unit):
+    results[name] = {'value': float(value), 'unit': unit, 'higher_is_better': HIGHER_IS_BETTER[unit]}
+    print("  " + name.ljust(56) + " " + str(round(value, 2)) + " " + unit)
+
+
+def benchmark_slicing(results, num_phrases, repeats):
+    pianorolls = synthetic_song(num_phrases)
+    assert np.array_equal(data_parser.slice_phrases_loop(pianorolls), data_parser.slice_phrases(pianorolls))
+
+    loop_time = time_call(lambda: data_parser.slice_phrases_loop(pianorolls), repeats)
+    vectorized_time = time_call(lambda: data_parser.slice_phrases(pianorolls), repeats)
+
+    print("Phrase slicing, " + str(num_phrases) + " phrases per song")
+    record(results, "slicing/loop", num_phrases/loop_time, 'phrases/sec')
+    record(results, "slicing/vectorized", num_phrases/vectorized_time, 'phrases/sec')
+
+def parse_dataset(genres_directory, parsed_directory, output_format):
+    #parses the synthetic songs, returns the seconds it took and the parsed data directory
+    start = time.perf_counter()
+    data_parser.parse_data(genres_directory, parsed_directory, 1, output_format)
+    elapsed = time.perf_counter() - start
+    return elapsed, glob.glob(join(parsed_directory, "NT-*"))[0]
+
+def benchmark_parse(results, work_directory, songs_per_genre, num_phrases, repeats):
+    genres_directory = join(work_directory, "genres")
+    write_synthetic_songs(genres_directory, songs_per_genre, num_phrases)
+    total_phrases = len(GENRE_LIST)*songs_per_genre*num_phrases
+
+    print("parse_data, " + str(total_phrases) + " phrases in " + str(len(GENRE_LIST)*songs_per_genre) + " songs, one worker")
+    for output_format in PARSE_FORMATS:
+        #parsing resumes over finished songs, so every repeat starts from an empty directory
+        times = []
+        for repeat in range(repeats):
+            parsed_directory = join(work_directory, "parsed-" + output_format)
+            shutil.rmtree(parsed_directory, ignore_errors=True)
+            times.append(parse_dataset(genres_directory, parsed_directory, output_format)[0])
+        record(results, "parse/" + output_format, total_phrases/np.median(times), 'phrases/sec')
+
+def benchmark_get_batch(results, work_directory, songs_per_genre, num_phrases, repeats):
+    import class_conditional_musegan
+    genres_directory = join(work_directory, "genres")
+    if not os.path.exists(genres_directory):
+        write_synthetic_songs(genres_directory, songs_per_genre, num_phrases)
+
+    print("Data.get_batch, batches of " + str(BATCH_SIZE) + ", phrase cache off")
+    for output_format in PARSE_FORMATS:
+        parsed_directory = join(work_directory, "parsed-" + output_format)
+        shutil.rmtree(parsed_directory, ignore_errors=True)
+        data_directory = parse_dataset(genres_directory, parsed_directory, output_format)[1]
+        data = class_conditional_musegan.Data(data_directory, cache_bytes=0, seed=0)
+        times = 1000*time_calls(data.get_batch, repeats)
+        record(results, "get_batch/" + output_format + "/p50", np.percentile(times, 50), 'ms')
+        record(results, "get_batch/" + output_format + "/p99", np.percentile(times, 99), 'ms')
+
+def benchmark_convert(results, work_directory, num_phrases, repeats):
+    from class_conditional_musegan_GAN import convert_to_npz
+    songs_directory = join(work_directory, "songs")
+    os.makedirs(songs_directory, exist_ok=True)
+    phrases = synthetic_phrases(num_phrases)
+
+    print("convert_to_npz, " + str(num_phrases) + " phrases")
+    seconds = time_call(lambda: [convert_to_npz(phrases[ii], songs_directory, "phrase_" + str(ii)) for ii in range(num_phrases)], repeats)
+    record(results, "convert_to_npz", num_phrases/seconds, 'phrases/sec')
+
+def model_graph(model, batch_size, config, batched_tracks):
+    #(forward op, forward+backward op, feed_dict) of one model on synthetic inputs
+    import tensorflow as tf
+    from class_conditional_musegan_GAN import Generator, Discriminator, Classifier
+    rng = np.random.RandomState(0)
+    if model == 'generator':
+        input_genre = tf.placeholder(dtype = tf.int32, shape = batch_size)
+        latent_vector = tf.placeholder(dtype = tf.float32, shape = [batch_size, config.LATENT_SIZE])
+        out = Generator(input_genre, latent_vector, config.LATENT_SIZE, config.NUM_TRACKS, config.NUM_CLASSES, batched_tracks)
+        feed_dict = {input_genre: rng.randint(config.NUM_CLASSES, size=batch_size), latent_vector: rng.randn(batch_size, config.LATENT_SIZE)}
+    else:
+        real_data = tf.placeholder(dtype = tf.float32, shape = [batch_size, config.NUM_BARS, config.BEATS_PER_BAR, config.NUM_NOTES, config.NUM_TRACKS])
+        if model == 'discriminator':
+            out = Discriminator(real_data, config.NUM_TRACKS, batched_tracks)
+        else:
+            out = Classifier(real_data, config.NUM_TRACKS, config.NUM_CLASSES, batched_tracks)[0]
+        feed_dict = {real_data: synthetic_phrases(batch_size).astype(np.float32)}
+    gradients = tf.gradients(tf.reduce_mean(out), tf.trainable_variables())
+    return out.op, tf.group(out, *gradients), feed_dict
+
+def benchmark_model(results, batch_sizes, repeats, use_gpu):
+    import tensorflow as tf
+    session_config = tf.ConfigProto() if use_gpu else tf.ConfigProto(device_count={'GPU': 0})
+
+    for config_name in CONFIG_VARIANTS:
+        config = importlib.import_module(config_name)
+        print(config_name + " models (" + str(config.NUM_CLASSES) + " classes, latent size " + str(config.LATENT_SIZE) + "), ms per batch")
+        for model in MODELS:
+            for layout in sorted(TRACK_LAYOUTS):
+                for batch_size in batch_sizes:
+                    tf.reset_default_graph()
+                    tf.set_random_seed(0)
+                    forward, backward, feed_dict = model_graph(model, batch_size, config, TRACK_LAYOUTS[layout])
+                    with tf.Session(config=session_config) as sess:
+                        sess.run(tf.global_variables_initializer())
+                        name = "model/" + config_name + "/" + model + "/" + layout + "/batch-" + str(batch_size)
+                        record(results, name + "/forward", 1000*np.median(time_calls(lambda: sess.run(forward, feed_dict=feed_dict), repeats)), 'ms')
+                        record(results, name + "/forward_backward", 1000*np.median(time_calls(lambda: sess.run(backward, feed_dict=feed_dict), repeats)), 'ms')
+
+
+def machine_info():
+    info = {'created': datetime.now().isoformat(), 'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count()}
+    if 'tensorflow' in sys.modules:
+        info['tensorflow'] = sys.modules['tensorflow'].__version__
+    return info
+
+def run(args):
+    results = {}
+    work_directory = tempfile.mkdtemp(prefix="benchmarks-")
+    try:
+        if 'slicing' in args.suites:
+            benchmark_slicing(results, args.num_phrases, args.repeats)
+        if 'parse' in args.suites:
+            benchmark_parse(results, work_directory, args.songs, args.num_phrases, args.repeats)
+        if 'get_batch' in args.suites:
+            benchmark_get_batch(results, work_directory, args.songs, args.num_phrases, args.batches)
+        if 'convert' in args.suites:
+            benchmark_convert(results, work_directory, args.num_phrases, args.repeats)
+        if 'model' in args.suites:
+            benchmark_model(results, args.batch_sizes, args.repeats, args.gpu)
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    report = {'machine': machine_info(), 'settings': vars(args), 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+        print("Results written to " + args.output)
+
+def compare(baseline, results, threshold):
+    #prints every shared benchmark and returns the names of the ones that got worse by more than threshold
+    regressions = []
+    shared = sorted(set(baseline['results']) & set(results['results']))
+    print("benchmark".ljust(56) + " " + "baseline".rjust(12) + " " + "new".rjust(12) + " " + "change".rjust(8))
+    for name in shared:
+        old = baseline['results'][name]
+        new = results['results'][name]
+        change = (new['value'] - old['value'])/old['value'] if old['value'] else 0.0
+        worse = -change if old['higher_is_better'] else change
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(name.ljust(56) + " " + str(round(old['value'], 2)).rjust(12) + " " + str(round(new['value'], 2)).rjust(12) + " " + (str(round(100*change, 1)) + "%").rjust(8) + flag)
+
+    for name in sorted(set(baseline['results']) ^ set(results['results'])):
+        print(name.ljust(56) + " only in " + ("the baseline" if name in baseline['results'] else "the new results"))
+    print(str(len(regressions)) + " of " + str(len(shared)) + " benchmarks regressed by more than " + str(round(100*threshold, 1)) + "%")
+    return regressions
+
+def parser():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='run benchmark suites')
+    run_parser.add_argument('-o', '--output', help='JSON file the results are written to')
+    run_parser.add_argument('-s', '--suites', nargs='+', choices=SUITES, default=SUITES)
+    run_parser.add_argument('-n', '--num-phrases', type=int, default=64, help='phrases per synthetic song and for convert_to_npz')
+    run_parser.add_argument('--songs', type=int, default=2, help='synthetic songs per genre for parse and get_batch')
+    run_parser.add_argument('-r', '--repeats', type=int, default=3)
+    run_parser.add_argument('--batches', type=int, default=50, help='get_batch calls timed per format')
+    run_parser.add_argument('-b', '--batch-sizes', type=int, nargs='+', default=[1, GENERATOR_BATCH_SIZE, BATCH_SIZE])
+    run_parser.add_argument('--gpu', action='store_true', help='let the model suite use a GPU, it runs on CPU otherwise')
+
+    compare_parser = commands.add_parser('compare', help='flag regressions between two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('-t', '--threshold', type=float, default=0.1, help='fraction a benchmark may get worse by')
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    args = parser()
+    if args.command == 'run':
+        run(args)
+    else:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        with open(args.results) as file:
+            results = json.load(file)
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
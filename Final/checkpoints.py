@@ -0,0 +1,121 @@
+import os
+import glob
+import time
+import pickle
+import threading
+from os.path import join, basename
+import tensorflow as tf
+from CONFIG import *
+
+##Asynchronous checkpointing with a retention policy
+##
+##A save first copies every global variable into a shadow copy inside the graph, which only pauses training for
+##one in-memory assign. A background thread then writes the shadow copies under the original variable names, so
+##the checkpoints restore like the ones tf.train.Saver writes. Only the keep_last newest checkpoints and the keep_best
+##best ones by the metric given to save are kept on disk, the rest are deleted once a newer save is written.
+##
+##Next to every checkpoint a pickled <checkpoint>.state file holds its metric and whatever training state the
+##trainer passes to save (step, RNG and data position), written before the checkpoint so that the checkpoint
+##tf.train.latest_checkpoint points at always has one. A manager opened on a directory with earlier checkpoints
+##keeps them under the same retention.
+
+STATE_SUFFIX = ".state"
+
+
+def load_state(path):
+    with open(path + STATE_SUFFIX, 'rb') as file:
+        return pickle.load(file)
+
+def latest_checkpoint(directory):
+    #newest checkpoint of a run and the training state saved with it
+    path = tf.train.latest_checkpoint(directory)
+    if path is None:
+        raise ValueError("No checkpoint to resume from in " + directory)
+    return path, load_state(path)
+
+class CheckpointManager(object):
+  def __init__(self, sess, directory, keep_last=CHECKPOINT_KEEP_LAST, keep_best=CHECKPOINT_KEEP_BEST, mode=CHECKPOINT_BEST_MODE):
+    if keep_last < 1:
+        raise ValueError("keep_last has to keep at least the newest checkpoint")
+    self.sess = sess
+    self.directory = directory
+    self.keep_last = keep_last
+    self.keep_best = keep_best
+    self.sign = 1 if mode == 'max' else -1
+    #(path, metric) of every checkpoint on disk, oldest first
+    #a state file without an .index is left by a crash before its checkpoint was written and is not a checkpoint
+    states = sorted(glob.glob(join(directory, "*" + STATE_SUFFIX)), key=os.path.getmtime)
+    paths = [path[:-len(STATE_SUFFIX)] for path in states if os.path.exists(path[:-len(STATE_SUFFIX)] + ".index")]
+    self.checkpoints = [(path, load_state(path)['metric']) for path in paths]
+    #the saving thread changes the list while the training thread reads it
+    self.lock = threading.Lock()
+
+    #shadow copies stay out of the variable collections, so other savers and initializers never see them
+    variables = tf.global_variables()
+    with tf.name_scope("checkpoint_snapshot"):
+        self.shadows = [tf.Variable(tf.zeros(variable.shape, variable.dtype.base_dtype), trainable=False, collections=[], name=variable.op.name) for variable in variables]
+        self.snapshot = tf.group(*[shadow.assign(variable) for shadow, variable in zip(self.shadows, variables)])
+    sess.run(tf.variables_initializer(self.shadows))
+    #the shadow copies are saved under the names of the variables they copy, checkpoint file bookkeeping stays with the manager
+    self.saver = tf.train.Saver({variable.op.name: shadow for variable, shadow in zip(variables, self.shadows)}, max_to_keep=None)
+
+    self.thread = None
+    self.error = None
+    self.pause = 0.0
+    self.saves = 0
+
+  def save(self, name, metric=None, state=None):
+    #snapshots the variables (and a copy of state) now and writes them as directory/name in the background
+    self.wait()
+    start = time.perf_counter()
+    self.sess.run(self.snapshot)
+    state = pickle.dumps(dict(state or {}, metric=metric))
+    self.pause += time.perf_counter() - start
+    self.saves += 1
+
+    path = join(self.directory, name)
+    self.thread = threading.Thread(target=self.write, args=(path, metric, state), daemon=True)
+    self.thread.start()
+
+  def write(self, path, metric, state):
+    try:
+        with open(path + STATE_SUFFIX + ".tmp", 'wb') as file:
+            file.write(state)
+        os.replace(path + STATE_SUFFIX + ".tmp", path + STATE_SUFFIX)
+        self.saver.save(self.sess, path, write_meta_graph=False)
+        with self.lock:
+            #a save under an existing name replaces that checkpoint, so retention never deletes the files of the new one
+            self.checkpoints = [checkpoint for checkpoint in self.checkpoints if checkpoint[0] != path]
+            self.checkpoints.append((path, metric))
+            self.apply_retention()
+    except Exception as error:
+        self.error = error
+
+  def apply_retention(self):
+    #called with the lock held
+    newest = self.checkpoints[-self.keep_last:]
+    scored = [checkpoint for checkpoint in self.checkpoints if checkpoint[1] is not None]
+    best = sorted(scored, key=lambda checkpoint: self.sign*checkpoint[1], reverse=True)[:self.keep_best]
+
+    for checkpoint in list(self.checkpoints):
+        if checkpoint not in newest and checkpoint not in best:
+            for filename in glob.glob(checkpoint[0] + ".index") + glob.glob(checkpoint[0] + ".data-*") + glob.glob(checkpoint[0] + ".meta") + glob.glob(checkpoint[0] + STATE_SUFFIX):
+                os.remove(filename)
+            self.checkpoints.remove(checkpoint)
+
+  def wait(self):
+    #blocks until the last save is on disk
+    if self.thread is not None:
+        self.thread.join()
+        self.thread = None
+    if self.error is not None:
+        raise self.error
+
+  def summary(self):
+    average = 1000*self.pause/max(self.saves, 1)
+    with self.lock:
+        kept = list(self.checkpoints)
+    return "CHECKPOINT ===> " + str(round(average, 2)) + "ms pause per save, " + str(len(kept)) + " kept: " + ", ".join(basename(path) for path, metric in kept)
+
+  def close(self):
+    self.wait()
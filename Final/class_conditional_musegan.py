@@ -18,6 +18,15 @@ import tensorflow.contrib.slim as slim
 from tensorflow.python.framework import ops
 
 from CONFIG import *
+import phrase_store
+import phrase_index
+import prefetch
+import tf_input
+import sampler
+import data_parallel
+import metrics
+import checkpoints
+import track_layers
 
 #Operations for implementing binary neurons. Code is from the R2RT blog post:
 #https://r2rt.com/binary-stochastic-neurons-in-tensorflow.html
@@ -393,7 +402,7 @@ def Classifierv2(residual_input, NUM_LAYERS, NUM_CLASSES):
 """
 
 
-def Classifier(refiner_out, NUM_TRACKS, NUM_CLASSES):
+def Classifier(refiner_out, NUM_TRACKS, NUM_CLASSES, batched_tracks=BATCHED_TRACKS):
   def my_leaky_relu(x):
     return tf.nn.leaky_relu(x, alpha=.5)
 
@@ -447,12 +456,16 @@ def Classifier(refiner_out, NUM_TRACKS, NUM_CLASSES):
     return dense
 
   #print(refiner_out.get_shape())
-  private_out = []
-  for i in range(NUM_TRACKS):
-    track = tf.expand_dims(refiner_out[:,:,:,:, i],axis=-1)
-    private_out.append (merged_private(tf.concat([pitch_time_private(track, i), time_pitch_private(track, i)], -1), i))
-
-  private_discriminator_out = tf.concat(private_out,-1)
+  if batched_tracks:
+    #each private layer runs once for all tracks, see track_layers
+    private_discriminator_out = track_layers.critic_private(refiner_out, NUM_TRACKS, 'classifier', 64)
+  else:
+    private_out = []
+    for i in range(NUM_TRACKS):
+      track = tf.expand_dims(refiner_out[:,:,:,:, i],axis=-1)
+      private_out.append (merged_private(tf.concat([pitch_time_private(track, i), time_pitch_private(track, i)], -1), i))
+
+    private_discriminator_out = tf.concat(private_out,-1)
   #print(private_discriminator_out)
   #exit()
   #print(private_discriminator_out.get_shape())
@@ -544,62 +557,148 @@ def adverserial_loss(D_fake_data, D_real_data, real_input_data, G_out, gradient_
   return discriminator_loss, generator_loss
 
 class Data(object):
-  def __init__(self, data_directory):
+  def __init__(self, data_directory, min_notes=MIN_PHRASE_NOTES, max_empty_bars=MAX_EMPTY_BARS, cache_bytes=PHRASE_CACHE_BYTES, genre_weights=GENRE_WEIGHTS, seed=SAMPLER_SEED, batch_size=BATCH_SIZE):
     #Only restrieves songs in folder that are from genres of interest
-    parsed_directory_list = os.listdir(data_directory)
     genre_dictionary = {}
+    self.store = phrase_store.PhraseStore(data_directory) if phrase_store.is_store(data_directory) else None
+    #shard stores are memory mapped and already cached by the OS, only phrase files need inflating every epoch
+    self.cache = phrase_store.PhraseCache(cache_bytes) if cache_bytes > 0 and self.store is None else None
+
+    #the phrase index gives genres and filters without opening a single phrase file
+    #a shard store is indexed by phrase number instead of by filename
+    if phrase_index.has_phrase_index(data_directory):
+        index = phrase_index.load_phrase_index(data_directory)
+        keep = phrase_index.phrase_filter(index, min_notes, max_empty_bars)
+        for genre in GENRE_LIST:
+            selected = np.nonzero(keep & (index['genre'] == genre))[0]
+            genre_dictionary[genre] = selected if self.store is not None else index['filename'][selected]
+    elif min_notes > 0 or max_empty_bars is not None:
+        raise ValueError("Filtering phrases needs the phrase index written by data_parser in " + data_directory)
+    elif self.store is not None:
+        for genre in GENRE_LIST:
+            genre_dictionary[genre] = self.store.genre_indices(genre)
+    else:
+        parsed_directory_list = os.listdir(data_directory)
+        for genre in GENRE_LIST:
+            genre_songs_list = [element for element in parsed_directory_list if element.split("-")[0] == genre]
+            genre_dictionary[genre] = np.asarray(genre_songs_list, dtype=str)
 
-    for genre in GENRE_LIST:
-        genre_songs_list = [element for element in parsed_directory_list if element.split("-")[0] == genre]
-        genre_dictionary[genre] = genre_songs_list
-
-    smallest_genre = min(genre_dictionary, key=lambda x:len(genre_dictionary[x]))
-    self.smallest_genre_length = len(genre_dictionary.get(smallest_genre))
+    #every phrase gets a file id into one elements array, genre_files holds the file ids of each genre id (its GENRE_LIST index)
+    self.elements = np.concatenate([genre_dictionary[genre] for genre in GENRE_LIST])
+    genre_offsets = np.cumsum([0] + [len(genre_dictionary[genre]) for genre in GENRE_LIST])
+    self.genre_files = [np.arange(genre_offsets[ii], genre_offsets[ii+1]) for ii in range(len(GENRE_LIST))]
 
     self.path = data_directory
-    self.genre_dictionary = genre_dictionary
-    self.songs = self.song_shuffler()
-    self.index_in_epoch = 0
-    self.num_examples = len(self.songs)
+    self.batch_size = batch_size
+    self.batch_buffer = self.new_batch_buffer()
+    #genres are mixed by weight instead of truncated to the smallest one, an epoch is as many phrases as the dataset holds
+    self.sampler = sampler.GenreSampler(self.genre_files, genre_weights, seed)
+    self.num_examples = len(self.elements)
 
     #print(genre_dictionary)
     #print(smallest_genre)
-    #print(self.smallest_genre_length)
-
-  def song_shuffler(self):
-      #shuffle equal amount of songs from each genre into song list for each epoch
-      songs_list = []
-
-      for genre in GENRE_LIST:
-          np.random.shuffle(self.genre_dictionary.get(genre))
-          songs_list += self.genre_dictionary.get(genre)[:self.smallest_genre_length]
 
-      np.random.shuffle(songs_list)
-      return songs_list
+  def new_batch_buffer(self):
+    #(phrases, labels) arrays a batch is decoded into, reused from batch to batch
+    return np.empty((self.batch_size,) + phrase_store.PHRASE_SHAPE, dtype=bool), np.empty(self.batch_size, dtype=np.int32)
 
   def get_batch(self):
-    start = self.index_in_epoch
-    self.index_in_epoch += BATCH_SIZE
+    #the returned arrays are overwritten by the next get_batch call
+    return self.load_batch(self.next_batch_elements(), self.batch_buffer)
 
-    # When all the training data is ran, shuffles it
-    if self.index_in_epoch > self.num_examples:
-        self.songs = self.song_shuffler()
+  def next_batch_elements(self):
+    #draws the (genre id, file id) rows of the next batch, the only part of batching that changes state
+    return self.sampler.sample(self.batch_size)
 
-        # Start next epoch
-        start = 0
-        self.index_in_epoch = BATCH_SIZE
-        assert BATCH_SIZE <= self.num_examples
-    end = self.index_in_epoch
+  def load_phrase(self, element, out):
+    #decodes one phrase into out and returns its genre
+    if self.store is not None:
+        self.store.read([element], out[np.newaxis])
+        return self.store.genre_names([element])[0]
+
+    if self.cache is not None:
+        cached = self.cache.get(element)
+        if cached is not None:
+            phrase_store.unpack_phrases(cached[0][np.newaxis], out[np.newaxis])
+            return cached[1]
 
     #This unzipping is done to save on storage and memeory since the files are mostly 0's
-    npz_data = [np.load(join(self.path,element))["data"] for element in self.songs[start:end]] #uncompress all npz files and load in "data" array
-    batch_data = [element[0].astype(bool) for element in npz_data] #corresponds to the songs data which is stored in the first element of the data array
-    batch_label = [GENRE_LIST.index(element[1]) for element in npz_data]  #corresponds to the label fo the song stored inteh first element of the data array
+    genre = phrase_store.load_phrase(join(self.path,element), out)
+    if self.cache is not None:
+        self.cache.put(element, phrase_store.pack_phrases(out[np.newaxis])[0], genre)
+    return genre
+
+  def load_batch(self, songs, out=None):
+    #decodes a batch of phrases into out, a new_batch_buffer pair, safe to call from a prefetching thread
+    batch_data, batch_label = out if out is not None else self.new_batch_buffer()
+    batch_label[:] = songs[:, 0]  #corresponds to the label fo the song stored with the phrase
+    elements = self.elements[songs[:, 1]]
+
+    if self.store is not None:
+        self.store.read(elements, batch_data)
+    else:
+        #dense and sparse phrase files are both decoded straight into the batch array
+        for ii, element in enumerate(elements):
+            self.load_phrase(element, batch_data[ii])
 
     return batch_data, batch_label
 
 #BULD FULL MODEL FOR TESTING SHAPES
+def classifier_forward(real_data, real_data_labels):
+    #classifier output and summed loss of all its heads for a batch of real data and labels
+    real_data = tf.cast(real_data, dtype= tf.float32)
+
+    #One hot encode data labels
+    labels = tf.one_hot(real_data_labels, NUM_CLASSES)
+
+    #Buld Classifier
+    #classifier_out = Classifierv2(real_data, NUM_LAYERS, NUM_CLASSES)
+    classifier_out, classifier_out_1, classifier_out_2, classifier_out_3 = Classifier(real_data, NUM_TRACKS, NUM_CLASSES)
+
+    #classifier_loss_functions = Loss_Functions(gp_coefficient = 1, discriminator_coefficient = 0.5)
+    classifier_cce_loss = classifier_loss(classifier_out, labels, 0, 0) + classifier_loss(classifier_out_1, labels, 0, 0) +classifier_loss(classifier_out_2, labels, 0, 0) +classifier_loss(classifier_out_3, labels, 0, 0)
+    #classifier_varlist = list(filter(lambda a : "classifier" in a.name, [v for v in tf.trainable_variables()]))
+    return classifier_out, classifier_cce_loss
+
+def build_classifier(real_data, real_data_labels):
+    #classifier output, summed loss of all its heads and streaming accuracy for a batch of real data and labels
+    classifier_out, classifier_cce_loss = classifier_forward(real_data, real_data_labels)
+    classifier_accuracy, acc_op = tf.metrics.accuracy(real_data_labels, tf.argmax(classifier_out, 1))
+    return classifier_out, classifier_cce_loss, classifier_accuracy, acc_op
+
+def build_classifier_steps(real_data, real_data_labels, steps_per_run, optimizer):
+    #steps_per_run optimizer steps over consecutive BATCH_SIZE slices of one steps_per_run*BATCH_SIZE batch, all in one sess.run
+    #the classifier variables (as resource variables, so every step reads the last update) and the optimizer slots
+    #must already exist from build_classifier and optimizer.minimize, the loop body reuses them
+    def body(step, loss_sum, correct_sum, count_sum):
+        #every op of a step waits for the previous step's update through the step counter
+        with tf.control_dependencies([step]):
+            step_data = real_data[step*BATCH_SIZE:(step + 1)*BATCH_SIZE]
+            step_labels = real_data_labels[step*BATCH_SIZE:(step + 1)*BATCH_SIZE]
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                classifier_out, classifier_cce_loss = classifier_forward(step_data, step_labels)
+            step_optim = optimizer.minimize(classifier_cce_loss)
+            correct = tf.reduce_sum(tf.cast(tf.equal(tf.argmax(classifier_out, 1, output_type=tf.int32), step_labels), tf.float32))
+        with tf.control_dependencies([step_optim]):
+            return step + 1, loss_sum + classifier_cce_loss, correct_sum + correct, count_sum + tf.cast(tf.size(step_labels), tf.float32)
+
+    loop = tf.while_loop(lambda step, loss_sum, correct_sum, count_sum: step < steps_per_run, body,
+                         [tf.constant(0), tf.constant(0.0), tf.constant(0.0), tf.constant(0.0)], parallel_iterations=1)
+    step, loss_sum, correct_sum, count_sum = loop
+
+    #mean loss of the steps, and the same streaming accuracy over every phrase seen as tf.metrics.accuracy gives
+    classifier_accuracy, acc_op = tf.metrics.mean(correct_sum/count_sum, weights=count_sum)
+    return loss_sum/steps_per_run, tf.group(*loop), classifier_accuracy, acc_op
+
+def classifier_optimizer():
+    return tf.train.AdamOptimizer(learning_rate=LEARNING_RATE, beta1=0.9, beta2=0.999, epsilon=1e-08, use_locking=False, name='Classifier_Optimizer')
+
 def main():
+    if DATA_PARALLEL_WORKERS > 1:
+        #synchronous data-parallel training over worker processes, see data_parallel
+        data_parallel.train('classifier', abspath(sys.argv[1]), sys.argv[2], DATA_PARALLEL_WORKERS)
+        return
+
     """
     tf.reset_default_graph()
 
@@ -628,24 +727,28 @@ def main():
     #TRAIN CLASSIFIER
     tf.reset_default_graph()
 
-    #pass in data for session, assumes data labels will be passed in with data
-    real_data = tf.placeholder(dtype = tf.bool, shape = [None, NUM_BARS, BEATS_PER_BAR, NUM_NOTES, NUM_TRACKS])
-    real_data = tf.cast(real_data, dtype= tf.float32)
-    real_data_labels = tf.placeholder(dtype = tf.int32, shape = None)
-
-    #One hot encode data labels
-    labels = tf.one_hot(real_data_labels, NUM_CLASSES)
+    data_path = abspath(sys.argv[1])
+    print("Loading in Data from: ", data_path)
+    #with STEPS_PER_RUN > 1 every batch holds the phrases of STEPS_PER_RUN steps
+    data = Data(data_path, batch_size=BATCH_SIZE*STEPS_PER_RUN) #Path to directory containing music set
 
-    #Buld Classifier
-    #classifier_out = Classifierv2(real_data, NUM_LAYERS, NUM_CLASSES)
-    classifier_out, classifier_out_1, classifier_out_2, classifier_out_3 = Classifier(real_data, NUM_TRACKS, NUM_CLASSES)
+    #pass in data for session, assumes data labels will be passed in with data
+    if INPUT_PIPELINE == 'tf_data':
+        #data and labels come straight from the tf.data iterator instead of being fed
+        real_data, real_data_labels = tf_input.make_input(data, BATCH_SIZE*STEPS_PER_RUN)
+    else:
+        real_data = tf.placeholder(dtype = tf.bool, shape = [None, NUM_BARS, BEATS_PER_BAR, NUM_NOTES, NUM_TRACKS])
+        real_data_labels = tf.placeholder(dtype = tf.int32, shape = None)
 
-    #classifier_loss_functions = Loss_Functions(gp_coefficient = 1, discriminator_coefficient = 0.5)
-    classifier_cce_loss = classifier_loss(classifier_out, labels, 0, 0) + classifier_loss(classifier_out_1, labels, 0, 0) +classifier_loss(classifier_out_2, labels, 0, 0) +classifier_loss(classifier_out_3, labels, 0, 0)
-    #classifier_varlist = list(filter(lambda a : "classifier" in a.name, [v for v in tf.trainable_variables()]))
-    optim = tf.train.AdamOptimizer(learning_rate=LEARNING_RATE, beta1=0.9, beta2=0.999, epsilon=1e-08, use_locking=False, name='Classifier_Optimizer').minimize(classifier_cce_loss)
+    #the multi-step loop reads the variables inside a tf.while_loop, which needs resource variables
+    with tf.variable_scope(tf.get_variable_scope(), use_resource=STEPS_PER_RUN > 1):
+        classifier_out, classifier_cce_loss, classifier_accuracy, acc_op = build_classifier(real_data, real_data_labels)
+        optimizer = classifier_optimizer()
+        optim = optimizer.minimize(classifier_cce_loss)
 
-    classifier_accuracy, acc_op = tf.metrics.accuracy(real_data_labels, tf.argmax(classifier_out, 1))
+        if STEPS_PER_RUN > 1:
+            #loss, training and accuracy of STEPS_PER_RUN steps come out of one run
+            classifier_cce_loss, optim, classifier_accuracy, acc_op = build_classifier_steps(real_data, real_data_labels, STEPS_PER_RUN, optimizer)
 
     print("Initialising session...")
     init_g = tf.global_variables_initializer()
@@ -653,17 +756,15 @@ def main():
     sess = tf.Session()
     sess.run(init_g)
     sess.run(init_l)
-    saver = tf.train.Saver()
 
     #print(LEARNING_RATE)
 
-    data_path = abspath(sys.argv[1])
-    print("Loading in Data from: ", data_path)
-    data = Data(data_path) #Path to directory containing music set
-
     models_directory = join(sys.argv[2], ("saved_models_" + datetime.now().strftime('%Y-%m-%d_%H:%M:%S')))
     os.makedirs(models_directory, exist_ok=True)
     accuracy_old = 0
+    metrics_writer = metrics.MetricsWriter(models_directory, ['loss', 'accuracy'])
+    #checkpoints are written in the background, only the newest and the most accurate stay on disk
+    checkpoint_manager = checkpoints.CheckpointManager(sess, models_directory)
 
     #with open(join(models_directory, "Model.csv"), 'w') as f:
        #f.write("LOSS,ACCURACY\n")
@@ -687,29 +788,51 @@ def main():
 
     #exit()
 
-    BATCHES_PER_EPOCH = int(data.num_examples/BATCH_SIZE)
+    #a batch is one run, STEPS_PER_RUN optimizer steps
+    BATCHES_PER_EPOCH = int(data.num_examples/(BATCH_SIZE*STEPS_PER_RUN))
 
     #progress = trange(1000, desc = 'Bar_desc', leave = True)
     progress = trange(BATCHES_PER_EPOCH*CLASSIFIER_EPOCHS, desc = 'Bar_desc', leave = True)
 
+    #batches are decoded in the background while the previous step runs
+    if INPUT_PIPELINE != 'tf_data':
+        batches = prefetch.Prefetcher(data)
+
     for t in progress:
-        data_batch, label_batch = data.get_batch()
-        loss_np, optim_np = sess.run([classifier_cce_loss, optim], feed_dict={real_data: data_batch, real_data_labels: label_batch})
-        accuracy = sess.run([classifier_accuracy, acc_op], feed_dict={real_data: data_batch, real_data_labels: label_batch})
+        if INPUT_PIPELINE == 'tf_data':
+            #one run per step, a second run would pull the next batch from the iterator
+            loss_np, optim_np, accuracy = sess.run([classifier_cce_loss, optim, [classifier_accuracy, acc_op]])
+        elif STEPS_PER_RUN > 1:
+            #a second run would train STEPS_PER_RUN more steps
+            data_batch, label_batch = batches.get_batch()
+            loss_np, optim_np, accuracy = sess.run([classifier_cce_loss, optim, [classifier_accuracy, acc_op]], feed_dict={real_data: data_batch, real_data_labels: label_batch})
+        else:
+            data_batch, label_batch = batches.get_batch()
+            loss_np, optim_np = sess.run([classifier_cce_loss, optim], feed_dict={real_data: data_batch, real_data_labels: label_batch})
+            accuracy = sess.run([classifier_accuracy, acc_op], feed_dict={real_data: data_batch, real_data_labels: label_batch})
 
         progress.set_description(' LOSS ===> ' + str(loss_np) + ' ACCURACY ===> ' + str(accuracy[1]))
         progress.refresh()
 
-        with open(join(models_directory, "Model.csv"), 'a') as f:
-            f.write(str(loss_np) + "," + str(accuracy[1]) + "\n")
+        metrics_writer.add(loss_np, accuracy[1])
 
         #print(data.num_examples)
         if t%BATCHES_PER_EPOCH == 0 or t==BATCHES_PER_EPOCH*CLASSIFIER_EPOCHS:
             print("Epoch Completed")
+            metrics_writer.flush()
+            if INPUT_PIPELINE != 'tf_data':
+                print(batches.wait_summary())
+            if data.cache is not None:
+                print(data.cache.summary())
             if accuracy[1]>accuracy_old:
                 accuracy_old = accuracy[1]
-                filename = "model-" + str((t*BATCH_SIZE)/data.num_examples)+"-"+str(accuracy_old)
-                saver.save(sess, join(models_directory, filename))
+                filename = "model-" + str((t*BATCH_SIZE*STEPS_PER_RUN)/data.num_examples)+"-"+str(accuracy_old)
+                checkpoint_manager.save(filename, accuracy_old)
+                print(checkpoint_manager.summary())
+    metrics_writer.close()
+    checkpoint_manager.close()
+    if INPUT_PIPELINE != 'tf_data':
+        batches.close()
     #print(classifier_out)
     out = sess.run([tf.nn.softmax(classifier_out)], feed_dict={real_data: data_batch, real_data_labels: label_batch})
     print(out)
@@ -9,6 +9,8 @@ Original file is located at
 
 import numpy as np
 import os, sys
+import argparse
+import glob
 from tqdm import trange, tqdm
 from os.path import dirname, abspath, basename, exists, splitext, join
 from datetime import datetime
@@ -19,6 +21,16 @@ import tensorflow.contrib.slim as slim
 from tensorflow.python.framework import ops
 
 from CONFIG import *
+import phrase_store
+import phrase_index
+import prefetch
+import tf_input
+import sampler
+import data_parallel
+import metrics
+import checkpoints
+import profiler
+import track_layers
 
 #Operations for implementing binary neurons. Code is from the R2RT blog post:
 #https://r2rt.com/binary-stochastic-neurons-in-tensorflow.html
@@ -204,7 +216,7 @@ def binary_wrapper(pre_activations_tensor, estimator,
 
 #ARCHITECTURE FUNCTIONS
 
-def Generator(input_genre, latent_vector, LATENT_SIZE, NUM_TRACKS, NUM_CLASSES):
+def Generator(input_genre, latent_vector, LATENT_SIZE, NUM_TRACKS, NUM_CLASSES, batched_tracks=BATCHED_TRACKS):
   def my_leaky_relu(x):
       return tf.nn.leaky_relu(x, alpha=.5)
 
@@ -262,6 +274,9 @@ def Generator(input_genre, latent_vector, LATENT_SIZE, NUM_TRACKS, NUM_CLASSES):
   #Loop Private Generators over all tracks and concat
   shared_out = shared_generator(class_input)
   #print(shared_out)
+  if batched_tracks:
+    #each private layer runs once for all tracks, see track_layers
+    return tf.sigmoid(track_layers.generator_private(shared_out, NUM_TRACKS))
   private_out = []
 
   for i in range(NUM_TRACKS):
@@ -271,7 +286,7 @@ def Generator(input_genre, latent_vector, LATENT_SIZE, NUM_TRACKS, NUM_CLASSES):
   return generator_out
 
 
-def Discriminator(refiner_out, NUM_TRACKS):
+def Discriminator(refiner_out, NUM_TRACKS, batched_tracks=BATCHED_TRACKS):
   def my_leaky_relu(x):
     return tf.nn.leaky_relu(x, alpha=.5)
 
@@ -325,12 +340,15 @@ def Discriminator(refiner_out, NUM_TRACKS):
     return dense
 
   #print(refiner_out.get_shape())
-  private_out = []
-  for i in range(NUM_TRACKS):
-    track = tf.expand_dims(refiner_out[:,:,:,:, i],axis=-1)
-    private_out.append (merged_private(tf.concat([pitch_time_private(track, i), time_pitch_private(track, i)], -1), i))
-
-  private_discriminator_out = tf.concat(private_out,-1)
+  if batched_tracks:
+    private_discriminator_out = track_layers.critic_private(refiner_out, NUM_TRACKS, 'discriminator', 32)
+  else:
+    private_out = []
+    for i in range(NUM_TRACKS):
+      track = tf.expand_dims(refiner_out[:,:,:,:, i],axis=-1)
+      private_out.append (merged_private(tf.concat([pitch_time_private(track, i), time_pitch_private(track, i)], -1), i))
+
+    private_discriminator_out = tf.concat(private_out,-1)
   shared_discriminator_out = shared_discriminator(private_discriminator_out)
   #num_features_1= shared_discriminator_out.get_shape()[1]*shared_discriminator_out.get_shape()[2]*shared_discriminator_out.get_shape()[3]*shared_discriminator_out.get_shape()[4]
   #discriminator_out_1 = tf.squeeze(tf.layers.dense(tf.reshape(shared_discriminator_out, [-1, num_features_1]), 1, name='discriminator_dense_out1'))
@@ -345,7 +363,7 @@ def Discriminator(refiner_out, NUM_TRACKS):
   return discriminator_out
   #return discriminator_out, discriminator_out_1, discriminator_out_2, discriminator_out_3
 
-def Classifier(refiner_out, NUM_TRACKS, NUM_CLASSES):
+def Classifier(refiner_out, NUM_TRACKS, NUM_CLASSES, batched_tracks=BATCHED_TRACKS):
   def my_leaky_relu(x):
     return tf.nn.leaky_relu(x, alpha=.5)
 
@@ -399,12 +417,15 @@ def Classifier(refiner_out, NUM_TRACKS, NUM_CLASSES):
     return dense
 
 
-  private_out = []
-  for i in range(NUM_TRACKS):
-    track = tf.expand_dims(refiner_out[:,:,:,:, i],axis=-1)
-    private_out.append (merged_private(tf.concat([pitch_time_private(track, i), time_pitch_private(track, i)], -1), i))
+  if batched_tracks:
+    private_discriminator_out = track_layers.critic_private(refiner_out, NUM_TRACKS, 'classifier', 64)
+  else:
+    private_out = []
+    for i in range(NUM_TRACKS):
+      track = tf.expand_dims(refiner_out[:,:,:,:, i],axis=-1)
+      private_out.append (merged_private(tf.concat([pitch_time_private(track, i), time_pitch_private(track, i)], -1), i))
 
-  private_discriminator_out = tf.concat(private_out,-1)
+    private_discriminator_out = tf.concat(private_out,-1)
   shared_discriminator_out = shared_discriminator(private_discriminator_out)
   num_features_1= shared_discriminator_out.get_shape()[1]*shared_discriminator_out.get_shape()[2]*shared_discriminator_out.get_shape()[3]*shared_discriminator_out.get_shape()[4]
   classifier_out_1 = tf.layers.dense(tf.reshape(shared_discriminator_out, [-1, num_features_1]),NUM_CLASSES, name='classifier_dense_out1')
@@ -474,35 +495,44 @@ def VAC_GAN_loss(fake_out, real_out, classifier_out, classifier_labels, discrimi
 
 
 class Data(object):
-  def __init__(self, data_directory):
+  def __init__(self, data_directory, min_notes=MIN_PHRASE_NOTES, max_empty_bars=MAX_EMPTY_BARS, cache_bytes=PHRASE_CACHE_BYTES, genre_weights=GENRE_WEIGHTS, seed=SAMPLER_SEED, batch_size=REAL_DATA_BATCH_SIZE):
     #Only restrieves songs in folder that are from genres of interest
-    parsed_directory_list = os.listdir(data_directory)
     genre_dictionary = {}
+    self.store = phrase_store.PhraseStore(data_directory) if phrase_store.is_store(data_directory) else None
+    #shard stores are memory mapped and already cached by the OS, only phrase files need inflating every epoch
+    self.cache = phrase_store.PhraseCache(cache_bytes) if cache_bytes > 0 and self.store is None else None
+
+    #the phrase index gives genres and filters without opening a single phrase file
+    #a shard store is indexed by phrase number instead of by filename
+    if phrase_index.has_phrase_index(data_directory):
+        index = phrase_index.load_phrase_index(data_directory)
+        keep = phrase_index.phrase_filter(index, min_notes, max_empty_bars)
+        for genre in GENRE_LIST:
+            selected = np.nonzero(keep & (index['genre'] == genre))[0]
+            genre_dictionary[genre] = selected if self.store is not None else index['filename'][selected]
+    elif min_notes > 0 or max_empty_bars is not None:
+        raise ValueError("Filtering phrases needs the phrase index written by data_parser in " + data_directory)
+    elif self.store is not None:
+        for genre in GENRE_LIST:
+            genre_dictionary[genre] = self.store.genre_indices(genre)
+    else:
+        parsed_directory_list = os.listdir(data_directory)
+        for genre in GENRE_LIST:
+            genre_songs_list = [element for element in parsed_directory_list if element.split("-")[0] == genre]
+            genre_dictionary[genre] = np.asarray(genre_songs_list, dtype=str)
 
-    for genre in GENRE_LIST:
-        genre_songs_list = [element for element in parsed_directory_list if element.split("-")[0] == genre]
-        genre_dictionary[genre] = genre_songs_list
-
-    smallest_genre = min(genre_dictionary, key=lambda x:len(genre_dictionary[x]))
-    self.smallest_genre_length = len(genre_dictionary.get(smallest_genre))
+    #every phrase gets a file id into one elements array, genre_files holds the file ids of each genre id (its GENRE_LIST index)
+    self.elements = np.concatenate([genre_dictionary[genre] for genre in GENRE_LIST])
+    genre_offsets = np.cumsum([0] + [len(genre_dictionary[genre]) for genre in GENRE_LIST])
+    self.genre_files = [np.arange(genre_offsets[ii], genre_offsets[ii+1]) for ii in range(len(GENRE_LIST))]
 
     self.path = data_directory
-    self.genre_dictionary = genre_dictionary
-    self.songs = self.song_shuffler()
-    self.index_in_epoch = 0
-    self.num_examples = len(self.songs)
-
+    self.batch_size = batch_size
+    self.batch_buffer = self.new_batch_buffer()
+    #genres are mixed by weight instead of truncated to the smallest one, an epoch is as many phrases as the dataset holds
+    self.sampler = sampler.GenreSampler(self.genre_files, genre_weights, seed)
+    self.num_examples = len(self.elements)
 
-  def song_shuffler(self):
-      #shuffle equal amount of songs from each genre into song list for each epoch
-      songs_list = []
-
-      for genre in GENRE_LIST:
-          np.random.shuffle(self.genre_dictionary.get(genre))
-          songs_list += self.genre_dictionary.get(genre)[:self.smallest_genre_length]
-
-      np.random.shuffle(songs_list)
-      return songs_list
 
   def get_noise(self):
       return np.random.randn(GENERATOR_BATCH_SIZE,LATENT_SIZE)
@@ -522,24 +552,48 @@ class Data(object):
 
      return discriminator_labels_real, discriminator_labels_fake
 
+  def new_batch_buffer(self):
+    #(phrases, labels) arrays a batch is decoded into, reused from batch to batch
+    return np.empty((self.batch_size,) + phrase_store.PHRASE_SHAPE, dtype=bool), np.empty(self.batch_size, dtype=np.int32)
+
   def get_batch(self):
-    start = self.index_in_epoch
-    self.index_in_epoch += REAL_DATA_BATCH_SIZE
+    #the returned arrays are overwritten by the next get_batch call
+    return self.load_batch(self.next_batch_elements(), self.batch_buffer)
+
+  def next_batch_elements(self):
+    #draws the (genre id, file id) rows of the next batch, the only part of batching that changes state
+    return self.sampler.sample(self.batch_size)
 
-    # When all the training data is ran, shuffles it
-    if self.index_in_epoch > self.num_examples:
-        self.songs = self.song_shuffler()
+  def load_phrase(self, element, out):
+    #decodes one phrase into out and returns its genre
+    if self.store is not None:
+        self.store.read([element], out[np.newaxis])
+        return self.store.genre_names([element])[0]
 
-        # Start next epoch
-        start = 0
-        self.index_in_epoch = REAL_DATA_BATCH_SIZE
-        assert BATCH_SIZE <= self.num_examples
-    end = self.index_in_epoch
+    if self.cache is not None:
+        cached = self.cache.get(element)
+        if cached is not None:
+            phrase_store.unpack_phrases(cached[0][np.newaxis], out[np.newaxis])
+            return cached[1]
 
     #This unzipping is done to save on storage and memeory since the files are mostly 0's
-    npz_data = [np.load(join(self.path,element))["data"] for element in self.songs[start:end]] #uncompress all npz files and load in "data" array
-    batch_data = [element[0].astype(bool) for element in npz_data] #corresponds to the songs data which is stored in the first element of the data array
-    #batch_label = [GENRE_LIST.index(element[1]) for element in npz_data]  #corresponds to the label fo the song stored inteh first element of the data array
+    genre = phrase_store.load_phrase(join(self.path,element), out)
+    if self.cache is not None:
+        self.cache.put(element, phrase_store.pack_phrases(out[np.newaxis])[0], genre)
+    return genre
+
+  def load_batch(self, songs, out=None):
+    #decodes a batch of phrases into out, a new_batch_buffer pair, safe to call from a prefetching thread
+    batch_data, batch_label = out if out is not None else self.new_batch_buffer()
+    batch_label[:] = songs[:, 0]  #corresponds to the label fo the song stored with the phrase
+    elements = self.elements[songs[:, 1]]
+
+    if self.store is not None:
+        self.store.read(elements, batch_data)
+    else:
+        #dense and sparse phrase files are both decoded straight into the batch array
+        for ii, element in enumerate(elements):
+            self.load_phrase(element, batch_data[ii])
 
     return batch_data
     #return batch_data, batch_label
@@ -569,23 +623,10 @@ def convert_to_npz(generated_phrase, songs_directory, song_name):
     pypianoroll.save(join(songs_directory, (song_name + ".npz")), multitrack)
 
 #BULD FULL MODEL FOR TESTING SHAPES
-def main():
-
-    tf.reset_default_graph()
-
-    print("\n\n")
-    print("Defining placeholders...")
-
-    input_genre = tf.placeholder(dtype = tf.int32, shape = GENERATOR_BATCH_SIZE)
-    latent_vector = tf.placeholder(dtype = tf.float32, shape = [GENERATOR_BATCH_SIZE,LATENT_SIZE])
-    real_data = tf.placeholder(dtype = tf.bool, shape = [REAL_DATA_BATCH_SIZE, NUM_BARS, BEATS_PER_BAR, NUM_NOTES, NUM_TRACKS])
+def build_gan(input_genre, latent_vector, real_data, discriminator_labels_real, discriminator_labels_fake):
+    #generator, both discriminator passes, classifier, losses and metrics of the GAN, returned by name
     real_data = tf.cast(real_data, tf.float32)
-    discriminator_labels_real = tf.placeholder(dtype = tf.float32, shape = REAL_DATA_BATCH_SIZE)
-    discriminator_labels_fake = tf.placeholder(dtype = tf.float32, shape = GENERATOR_BATCH_SIZE)
-    #real_data_labels = tf.placeholder(dtype = tf.int32, shape = None)
-    #labels = tf.one_hot(real_data_labels, NUM_CLASSES)
 
-    print("Constructing Model...")
     generator_out = Generator(input_genre, latent_vector, LATENT_SIZE, NUM_TRACKS, NUM_CLASSES)
     #refiner_out = Refiner(generator_out, NUM_TRACKS, RESIDUAL_LAYERS, SLOPE_TENSOR)
 
@@ -624,8 +665,99 @@ def main():
     generator_varlist = list(filter(lambda a : "generator" in a.name, [v for v in tf.trainable_variables()]))
     discriminator_varlist = list(filter(lambda a : "discriminator" in a.name, [v for v in tf.trainable_variables()]))
 
-    generator_optim = tf.train.AdamOptimizer(learning_rate=GENERATOR_LEARNING_RATE, beta1=BETA_1, beta2=BETA_2, epsilon=1e-08, use_locking=False, name='Generator_Optimizer').minimize(generator_loss, var_list = generator_varlist)
-    discriminator_optim = tf.train.AdamOptimizer(learning_rate=DISCRIMINATOR_LEARNING_RATE, beta1=BETA_1, beta2=BETA_2, epsilon=1e-08, use_locking=False, name='Discriminator_Optimizer').minimize(discriminator_loss, var_list = discriminator_varlist)
+    return {'generator_out': generator_out, 'fake_out': fake_out, 'real_out': real_out, 'classifier_out': classifier_out, 'variance': variance,
+            'generator_loss': generator_loss, 'discriminator_loss': discriminator_loss,
+            'classifier_accuracy': classifier_accuracy, 'acc_op': acc_op, 'discriminator_accuracy': discriminator_accuracy, 'acc_disc': acc_disc,
+            'generator_varlist': generator_varlist, 'discriminator_varlist': discriminator_varlist}
+
+def optimistic_restore(session, save_file, graph=None):
+    #restores every variable of the default graph that the checkpoint has with the same name and shape
+    graph = tf.get_default_graph() if graph is None else graph
+    reader = tf.train.NewCheckpointReader(save_file)
+    saved_shapes = reader.get_variable_to_shape_map()
+
+    #private track layers saved with the other BATCHED_TRACKS setting would match no variable and silently keep their
+    #initial weights, so the checkpoint is converted to the layout of the graph first
+    graph_layout = track_layers.variables_layout([var.op.name for var in tf.global_variables()])
+    saved_layout = track_layers.variables_layout(saved_shapes)
+    if graph_layout is not None and saved_layout is not None and graph_layout != saved_layout:
+        print("Converting the private track layers of " + save_file + " from " + saved_layout + " to " + graph_layout)
+        values = track_layers.read_checkpoint(save_file, graph_layout)
+        for var in tf.global_variables():
+            if var.op.name in values and var.get_shape().as_list() == list(values[var.op.name].shape):
+                var.load(values[var.op.name], session)
+        return
+
+    var_names = sorted([(var.name, var.name.split(':')[0]) for var in tf.global_variables()
+        if var.name.split(':')[0] in saved_shapes])
+    restore_vars = []
+    for var_name, saved_var_name in var_names:
+        curr_var = graph.get_tensor_by_name(var_name)
+        var_shape = curr_var.get_shape().as_list()
+        if var_shape == saved_shapes[saved_var_name]:
+            restore_vars.append(curr_var)
+    opt_saver = tf.train.Saver(restore_vars)
+    opt_saver.restore(session, save_file)
+
+def restore_classifier(session, classifier_checkpoint):
+    #loads the newest checkpoint of a trained classifier run into the GAN's classifier
+    checkpoint_path = tf.train.latest_checkpoint(classifier_checkpoint)
+    if checkpoint_path is None:
+        raise ValueError("No classifier checkpoint in " + classifier_checkpoint)
+    optimistic_restore(session, checkpoint_path)
+
+def gan_optimizers():
+    generator_optimizer = tf.train.AdamOptimizer(learning_rate=GENERATOR_LEARNING_RATE, beta1=BETA_1, beta2=BETA_2, epsilon=1e-08, use_locking=False, name='Generator_Optimizer')
+    discriminator_optimizer = tf.train.AdamOptimizer(learning_rate=DISCRIMINATOR_LEARNING_RATE, beta1=BETA_1, beta2=BETA_2, epsilon=1e-08, use_locking=False, name='Discriminator_Optimizer')
+    return generator_optimizer, discriminator_optimizer
+
+def main():
+    parser = argparse.ArgumentParser(description="Trains the class conditional GAN")
+    parser.add_argument("data_directory")
+    parser.add_argument("models_directory", help="each run writes a saved_models_<date> directory in here")
+    parser.add_argument("songs_directory", help="each run writes a generated_song_<date> directory in here")
+    parser.add_argument("-c", "--classifier-checkpoint", help="directory of a trained classifier run whose weights are loaded into the GAN's classifier")
+    parser.add_argument("-p", "--profile", action="store_true", help="time every phase of the training step and write a Chrome trace every PROFILE_TRACE_EVERY steps")
+    parser.add_argument("-r", "--resume", action="store_true", help="continue the newest run in models_directory from its latest checkpoint, or start one if there is none")
+    args = parser.parse_args()
+
+    if DATA_PARALLEL_WORKERS > 1:
+        #synchronous data-parallel training over worker processes, see data_parallel
+        if args.resume or args.profile:
+            parser.error("--resume and --profile are not supported with DATA_PARALLEL_WORKERS > 1")
+        data_parallel.train('gan', abspath(args.data_directory), args.models_directory, DATA_PARALLEL_WORKERS, args.classifier_checkpoint)
+        return
+
+    tf.reset_default_graph()
+
+    data_path = abspath(args.data_directory)
+    print("Loading in Data from: ", data_path)
+    data = Data(data_path) #Path to directory containing music set
+
+    print("\n\n")
+    print("Defining placeholders...")
+
+    input_genre = tf.placeholder(dtype = tf.int32, shape = GENERATOR_BATCH_SIZE)
+    latent_vector = tf.placeholder(dtype = tf.float32, shape = [GENERATOR_BATCH_SIZE,LATENT_SIZE])
+    if INPUT_PIPELINE == 'tf_data':
+        #real data comes straight from the tf.data iterator instead of being fed
+        real_data = tf_input.make_input(data, REAL_DATA_BATCH_SIZE)[0]
+    else:
+        real_data = tf.placeholder(dtype = tf.bool, shape = [REAL_DATA_BATCH_SIZE, NUM_BARS, BEATS_PER_BAR, NUM_NOTES, NUM_TRACKS])
+    discriminator_labels_real = tf.placeholder(dtype = tf.float32, shape = REAL_DATA_BATCH_SIZE)
+    discriminator_labels_fake = tf.placeholder(dtype = tf.float32, shape = GENERATOR_BATCH_SIZE)
+    #real_data_labels = tf.placeholder(dtype = tf.int32, shape = None)
+    #labels = tf.one_hot(real_data_labels, NUM_CLASSES)
+
+    print("Constructing Model...")
+    model = build_gan(input_genre, latent_vector, real_data, discriminator_labels_real, discriminator_labels_fake)
+    generator_out, variance = model['generator_out'], model['variance']
+    generator_loss, discriminator_loss = model['generator_loss'], model['discriminator_loss']
+    acc_op, acc_disc = model['acc_op'], model['acc_disc']
+
+    generator_optimizer, discriminator_optimizer = gan_optimizers()
+    generator_optim = generator_optimizer.minimize(generator_loss, var_list = model['generator_varlist'])
+    discriminator_optim = discriminator_optimizer.minimize(discriminator_loss, var_list = model['discriminator_varlist'])
 
 
     #INITIALIZE VARIABLES
@@ -636,29 +768,20 @@ def main():
     sess.run(init_g)
     sess.run(init_l)
 
-    saver = tf.train.Saver()
-
-    def optimistic_restore(session, save_file, graph=tf.get_default_graph()):
-        reader = tf.train.NewCheckpointReader(save_file)
-        saved_shapes = reader.get_variable_to_shape_map()
-        var_names = sorted([(var.name, var.name.split(':')[0]) for var in tf.global_variables()
-            if var.name.split(':')[0] in saved_shapes])
-        restore_vars = []
-        for var_name, saved_var_name in var_names:
-            curr_var = graph.get_tensor_by_name(var_name)
-            var_shape = curr_var.get_shape().as_list()
-            if var_shape == saved_shapes[saved_var_name]:
-                restore_vars.append(curr_var)
-        opt_saver = tf.train.Saver(restore_vars)
-        opt_saver.restore(session, save_file)
-
     #LOAD IN CLASSIFIER_WEIGHTS
-    checkpoint_path = r'/home/cofphe/Documents/jacob-luka/Models/saved_models_2018-12-13_00:29:45'
-    optimistic_restore(sess, tf.train.latest_checkpoint(checkpoint_path))
-
-    data_path = abspath(sys.argv[1])
-    print("Loading in Data from: ", data_path)
-    data = Data(data_path) #Path to directory containing music set
+    if args.classifier_checkpoint is not None:
+        restore_classifier(sess, args.classifier_checkpoint)
+    elif not args.resume:
+        print("No --classifier-checkpoint given, the classifier starts untrained")
+
+    #a resumed run restores every variable, Adam slots included, and the training state saved next to the checkpoint
+    resume_state = None
+    runs = sorted(glob.glob(join(args.models_directory, "saved_models_*")))
+    if args.resume and runs and tf.train.latest_checkpoint(runs[-1]) is not None:
+        models_directory = runs[-1]
+        checkpoint_path, resume_state = checkpoints.latest_checkpoint(models_directory)
+        tf.train.Saver().restore(sess, checkpoint_path)
+        print("Resuming from " + checkpoint_path + " after step " + str(resume_state['step']))
 
     """
     #TEST TO MAKE SURE CLASSIFIER WEIGHTS LOADING CORRECTLY
@@ -677,11 +800,12 @@ def main():
     """
 
 
-    models_directory = join(sys.argv[2], ("saved_models_" + datetime.now().strftime('%Y-%m-%d_%H:%M:%S')))
-    os.makedirs(models_directory, exist_ok=True)
+    if resume_state is None:
+        models_directory = join(args.models_directory, ("saved_models_" + datetime.now().strftime('%Y-%m-%d_%H:%M:%S')))
+        os.makedirs(models_directory, exist_ok=True)
     accuracy_old = 0
 
-    songs_directory = join(sys.argv[3], ("generated_song_" + datetime.now().strftime('%Y-%m-%d_%H:%M:%S')))
+    songs_directory = join(args.songs_directory, ("generated_song_" + datetime.now().strftime('%Y-%m-%d_%H:%M:%S')))
     os.makedirs(songs_directory, exist_ok=True)
 
     #with open(join(models_directory, "Model.csv"), 'w') as f:
@@ -712,30 +836,81 @@ def main():
     #exit()
     BATCHES_PER_EPOCH = int(data.num_examples/REAL_DATA_BATCH_SIZE)
 
+    #continue with the step, random numbers and batch order the checkpoint was taken at
+    #(the tf.data pipeline cannot be repositioned, it starts a new shuffle)
+    start_step = 0
+    resume_rows = ()
+    #the discriminator only trains every G_D_ASPECT_RATIO steps, its loss is NaN until it first does
+    loss_discriminator = float('nan')
+    if resume_state is not None:
+        start_step = resume_state['step'] + 1
+        if start_step >= BATCHES_PER_EPOCH*GAN_EPOCHS:
+            print("Nothing to resume, " + models_directory + " finished all " + str(BATCHES_PER_EPOCH*GAN_EPOCHS) + " steps")
+            return
+        loss_discriminator = resume_state.get('discriminator_loss', loss_discriminator)
+        np.random.set_state(resume_state['numpy_random'])
+        data.sampler.set_state(resume_state['sampler'])
+        resume_rows = resume_state['pending_rows']
+        metrics.truncate_metrics(models_directory, start_step)
+
+    metrics_writer = metrics.MetricsWriter(models_directory, ['generator_loss', 'discriminator_loss', 'classifier_accuracy', 'discriminator_accuracy', 'variance'], first_step=start_step)
+    #checkpoints are written in the background, only the newest ones and the ones with the best class accuracy stay on disk
+    checkpoint_manager = checkpoints.CheckpointManager(sess, models_directory)
+    #with --profile, where the time of a step goes (with tf_data the data wait happens inside sess_run)
+    step_profiler = profiler.StepProfiler(join(models_directory, "profile"), args.profile)
+
     #progress = trange(2000, desc = 'Bar_desc', leave = True)
-    progress = trange(BATCHES_PER_EPOCH*GAN_EPOCHS, desc = 'Bar_desc', leave = True)
+    progress = trange(start_step, BATCHES_PER_EPOCH*GAN_EPOCHS, desc = 'Bar_desc', leave = True)
+
+    #real data is decoded in the background while the previous step runs
+    if INPUT_PIPELINE != 'tf_data':
+        batches = prefetch.Prefetcher(data, resume_rows=resume_rows)
+
+    def training_state(t):
+        #where training is once step t is done, saved with every checkpoint for --resume
+        return {'step': t, 'numpy_random': np.random.get_state(), 'sampler': data.sampler.get_state(), 'discriminator_loss': loss_discriminator,
+                'pending_rows': batches.pending_rows() if INPUT_PIPELINE != 'tf_data' else []}
 
     for t in progress:
-        genre_batch = data.get_genre()
-        data_batch = data.get_batch()
-        latent_batch = data.get_noise()
-        discriminator_labels_real_batch, discriminator_labels_fake_batch = data.get_labels()
+        with step_profiler.phase('labels'):
+            genre_batch = data.get_genre()
+        with step_profiler.phase('noise'):
+            latent_batch = data.get_noise()
+        with step_profiler.phase('labels'):
+            discriminator_labels_real_batch, discriminator_labels_fake_batch = data.get_labels()
+        feed_dict = {input_genre: genre_batch, latent_vector: latent_batch, discriminator_labels_real: discriminator_labels_real_batch, discriminator_labels_fake: discriminator_labels_fake_batch}
+        if INPUT_PIPELINE != 'tf_data':
+            with step_profiler.phase('data_wait'):
+                feed_dict[real_data] = batches.get_batch()
         #print(sess.run([variance],feed_dict={input_genre: genre_batch, latent_vector: latent_batch, real_data: data_batch, discriminator_labels_real: discriminator_labels_real_batch, discriminator_labels_fake: discriminator_labels_fake_batch}))
-        if t%G_D_ASPECT_RATIO == 0:
-            loss_generator, optim_generator, loss_discriminator, optim_discriminator, class_acc, disc_acc, variance_batch = sess.run([generator_loss, generator_optim, discriminator_loss, discriminator_optim, acc_op, acc_disc, variance],feed_dict={input_genre: genre_batch, latent_vector: latent_batch, real_data: data_batch, discriminator_labels_real: discriminator_labels_real_batch, discriminator_labels_fake: discriminator_labels_fake_batch})
-        else:
-            loss_generator, optim_generator, class_acc, disc_acc, variance_batch = sess.run([generator_loss, generator_optim, acc_op, acc_disc, variance],feed_dict={input_genre: genre_batch, latent_vector: latent_batch, real_data: data_batch, discriminator_labels_real: discriminator_labels_real_batch, discriminator_labels_fake: discriminator_labels_fake_batch})
+        run_options, run_metadata = step_profiler.run_options(t)
+        with step_profiler.phase('sess_run'):
+            if t%G_D_ASPECT_RATIO == 0:
+                loss_generator, optim_generator, loss_discriminator, optim_discriminator, class_acc, disc_acc, variance_batch = sess.run([generator_loss, generator_optim, discriminator_loss, discriminator_optim, acc_op, acc_disc, variance],feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+            else:
+                loss_generator, optim_generator, class_acc, disc_acc, variance_batch = sess.run([generator_loss, generator_optim, acc_op, acc_disc, variance],feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
         progress.set_description('GEN LOSS ===> ' + str(loss_generator) + ' DIS LOSS ===> ' + str(loss_discriminator) + '  CLASS ACC ===> ' + str(class_acc) + '  DISC ACC ===> ' + str(disc_acc) + '  VAR ===> ' + str(variance_batch))
         progress.refresh()
 
-        with open(join(models_directory, "Model.csv"), 'a') as f:
-            f.write(str(loss_generator) + "," + str(loss_discriminator) + ","  + str(class_acc) +  ","  + str(disc_acc) +  ","  + str(variance_batch) + "\n")
+        with step_profiler.phase('metrics'):
+            metrics_writer.add(loss_generator, loss_discriminator, class_acc, disc_acc, variance_batch)
+        step_profiler.end_step()
+        #traces are written outside the timed step
+        step_profiler.write_trace(t, run_metadata)
         if t%BATCHES_PER_EPOCH == 0 or t==BATCHES_PER_EPOCH*GAN_EPOCHS:
             print("Epoch Completed")
+            metrics_writer.flush()
+            if args.profile:
+                print(step_profiler.summary())
+            if INPUT_PIPELINE != 'tf_data':
+                print(batches.wait_summary())
+            if data.cache is not None:
+                print(data.cache.summary())
             print("Making Music")
             filename = "model-" + str((t*BATCH_SIZE)/data.num_examples)+"-"+str(class_acc)
-            saver.save(sess, join(models_directory, filename))
-            generated_music, generated_genre = sess.run([tf.cast(tf.round(generator_out), tf.bool), input_genre],feed_dict={input_genre: genre_batch, latent_vector: latent_batch, real_data: data_batch, discriminator_labels_real: discriminator_labels_real_batch, discriminator_labels_fake: discriminator_labels_fake_batch})
+            checkpoint_manager.save(filename, class_acc, training_state(t))
+            print(checkpoint_manager.summary())
+            generated_music, generated_genre = sess.run([tf.cast(tf.round(generator_out), tf.bool), input_genre],feed_dict=feed_dict)
             print("NUM NOTES", np.sum(generated_music))
             for jj in range(GENERATOR_BATCH_SIZE):
                 if generated_genre[jj] == 0:
@@ -746,8 +921,18 @@ def main():
                     generate_genre_name = 'classic'
                 generated_phrase = generated_music[jj,:,:,:,:]
                 convert_to_npz(generated_phrase, songs_directory, (str(jj)+ '_'+generate_genre_name +'_EPOCH_' + str(int(t/BATCHES_PER_EPOCH))))
-
-    generator_out_batch, generated_music, generated_genre = sess.run([generator_out, tf.cast(tf.round(generator_out), tf.bool), input_genre],feed_dict={input_genre: genre_batch, latent_vector: latent_batch, real_data: data_batch, discriminator_labels_real: discriminator_labels_real_batch, discriminator_labels_fake: discriminator_labels_fake_batch})
+        elif t%CHECKPOINT_EVERY_STEPS == 0:
+            #metrics up to step t are on disk before the checkpoint a resume would start after
+            metrics_writer.flush()
+            checkpoint_manager.save("model-step-" + str(t), state=training_state(t))
+
+    metrics_writer.close()
+    checkpoint_manager.close()
+    if INPUT_PIPELINE != 'tf_data':
+        batches.close()
+    if args.profile:
+        print(step_profiler.summary())
+    generator_out_batch, generated_music, generated_genre = sess.run([generator_out, tf.cast(tf.round(generator_out), tf.bool), input_genre],feed_dict=feed_dict)
     print(generator_out_batch[0,1,:,:,1])
     print('\n\n')
     print(generated_music[0,1,:,:,1])
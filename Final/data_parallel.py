@@ -0,0 +1,271 @@
+import os, sys
+import time
+import argparse
+import importlib
+import multiprocessing
+from os.path import abspath, join
+from datetime import datetime
+import numpy as np
+import tensorflow as tf
+from tqdm import trange
+from CONFIG import *
+import prefetch
+import sampler
+import metrics
+import checkpoints
+
+##Synchronous data-parallel training of the classifier or the GAN over worker processes on one machine
+##
+##Every worker builds the same graph, keeps a disjoint shard of the phrases of each genre and feeds its own
+##batches. Each step the local gradients (and the scalar metrics of the step) of all workers are averaged with a
+##shared memory all-reduce, then every worker applies the same averaged gradients, so the replicas stay identical
+##and the effective batch is workers * batch size. Worker 0 starts everyone from its initial weights (with the GAN,
+##after loading the trained classifier into them), writes Model.csv and the checkpoints. Songs are not rendered,
+##and runs can be neither resumed nor profiled in this mode.
+
+TRAINERS = {'classifier': 'class_conditional_musegan', 'gan': 'class_conditional_musegan_GAN'}
+METRIC_SLOTS = 16
+SCALING_WORKERS = [1, 2, 4, 8]
+METRIC_COLUMNS = {'classifier': ['loss', 'accuracy'], 'gan': ['generator_loss', 'discriminator_loss', 'classifier_accuracy', 'discriminator_accuracy', 'variance']}
+
+
+class AllReduce(object):
+  #averages float32 vectors over workers, every worker has to call average (or broadcast) in the same order
+  def __init__(self, num_workers, size, context):
+    self.num_workers = num_workers
+    self.size = size
+    self.slots = context.RawArray('f', num_workers*size)
+    self.result = context.RawArray('f', size)
+    self.barrier = context.Barrier(num_workers)
+
+  def average(self, worker, values):
+    #reduce-scatter then all-gather: each worker averages one chunk of the vector and everyone copies the result
+    slots = np.frombuffer(self.slots, dtype=np.float32).reshape(self.num_workers, self.size)
+    result = np.frombuffer(self.result, dtype=np.float32)
+    slots[worker, :len(values)] = values
+    self.barrier.wait()
+
+    chunk = slice(worker*len(values)//self.num_workers, (worker + 1)*len(values)//self.num_workers)
+    result[chunk] = slots[:, chunk].mean(axis=0)
+    self.barrier.wait()
+    return result[:len(values)].copy()
+
+  def broadcast(self, worker, values):
+    #every worker gets the values of worker 0, written once everyone is done reading the previous result
+    result = np.frombuffer(self.result, dtype=np.float32)
+    self.barrier.wait()
+    if worker == 0:
+        result[:len(values)] = values
+    self.barrier.wait()
+    return result[:len(values)].copy()
+
+
+class AveragedUpdate(object):
+  #an optimizer step whose gradients are computed locally and applied once they are averaged over all workers
+  def __init__(self, optimizer, loss, var_list=None):
+    grads_and_vars = [(gradient, variable) for gradient, variable in optimizer.compute_gradients(loss, var_list) if gradient is not None]
+    self.variables = [variable for gradient, variable in grads_and_vars]
+    self.gradients = [tf.convert_to_tensor(gradient) for gradient, variable in grads_and_vars]
+    self.averaged = [tf.placeholder(tf.float32, variable.shape) for variable in self.variables]
+    self.apply = optimizer.apply_gradients(zip(self.averaged, self.variables))
+    self.size = sum(int(np.prod(variable.shape.as_list())) for variable in self.variables)
+
+
+def build_replica(trainer):
+  #placeholders, updates and fetched metrics of one replica, built by the trainer's own graph functions
+  module = importlib.import_module(TRAINERS[trainer])
+  phrase_shape = [NUM_BARS, BEATS_PER_BAR, NUM_NOTES, NUM_TRACKS]
+
+  if trainer == 'classifier':
+      real_data = tf.placeholder(dtype = tf.bool, shape = [None] + phrase_shape)
+      real_data_labels = tf.placeholder(dtype = tf.int32, shape = None)
+      classifier_out, classifier_cce_loss, classifier_accuracy, acc_op = module.build_classifier(real_data, real_data_labels)
+      updates = [AveragedUpdate(module.classifier_optimizer(), classifier_cce_loss)]
+      placeholders = {'real_data': real_data, 'real_data_labels': real_data_labels}
+      return module, placeholders, updates, [classifier_cce_loss, acc_op]
+
+  placeholders = {
+      'input_genre': tf.placeholder(dtype = tf.int32, shape = GENERATOR_BATCH_SIZE),
+      'latent_vector': tf.placeholder(dtype = tf.float32, shape = [GENERATOR_BATCH_SIZE, LATENT_SIZE]),
+      'real_data': tf.placeholder(dtype = tf.bool, shape = [REAL_DATA_BATCH_SIZE] + phrase_shape),
+      'discriminator_labels_real': tf.placeholder(dtype = tf.float32, shape = REAL_DATA_BATCH_SIZE),
+      'discriminator_labels_fake': tf.placeholder(dtype = tf.float32, shape = GENERATOR_BATCH_SIZE),
+  }
+  model = module.build_gan(placeholders['input_genre'], placeholders['latent_vector'], placeholders['real_data'], placeholders['discriminator_labels_real'], placeholders['discriminator_labels_fake'])
+  generator_optimizer, discriminator_optimizer = module.gan_optimizers()
+  updates = [AveragedUpdate(generator_optimizer, model['generator_loss'], model['generator_varlist']),
+             AveragedUpdate(discriminator_optimizer, model['discriminator_loss'], model['discriminator_varlist'])]
+  return module, placeholders, updates, [model['generator_loss'], model['discriminator_loss'], model['acc_op'], model['acc_disc'], model['variance']]
+
+def replica_size(trainer):
+  #length of the all-reduce vector, the gradients of every update plus room for the step metrics,
+  #or every trainable variable for the initial broadcast (the GAN's classifier is trainable but never updated)
+  with tf.Graph().as_default():
+      module, placeholders, updates, step_fetches = build_replica(trainer)
+      variables_size = sum(int(np.prod(variable.shape.as_list())) for variable in tf.trainable_variables())
+      return max(sum(update.size for update in updates) + METRIC_SLOTS, variables_size)
+
+def shard_data(data, worker, num_workers):
+  #keeps every num_workers-th phrase of each genre so no two workers read the same phrase
+  #the genre weights are worked out again on the shard: a genre with fewer phrases than workers is empty on some of
+  #them, which 'balanced' and 'proportional' leave out there, explicit weights that still ask for it are an error
+  data.genre_files = [files[worker::num_workers] for files in data.genre_files]
+  seed = None if data.sampler.seed is None else data.sampler.seed + worker
+  try:
+      data.sampler = sampler.GenreSampler(data.genre_files, data.sampler.weight_spec, seed)
+  except ValueError as error:
+      raise ValueError("Worker " + str(worker) + " of " + str(num_workers) + " has no phrases of a weighted genre, use fewer workers: " + str(error))
+
+def synchronous_step(sess, allreduce, worker, updates, step_fetches, feed_dict):
+  #local gradients and metrics, averaged over all workers, then applied; returns the averaged metrics
+  gradients, values = sess.run([[update.gradients for update in updates], step_fetches], feed_dict=feed_dict)
+  flat = np.concatenate([np.ravel(gradient) for update_gradients in gradients for gradient in update_gradients] + [np.ravel(values)]).astype(np.float32)
+  averaged = allreduce.average(worker, flat)
+
+  apply_feed = {}
+  offset = 0
+  for update, update_gradients in zip(updates, gradients):
+      for placeholder, gradient in zip(update.averaged, update_gradients):
+          apply_feed[placeholder] = averaged[offset:offset + gradient.size].reshape(gradient.shape)
+          offset += gradient.size
+  sess.run([update.apply for update in updates], feed_dict=apply_feed)
+  return averaged[offset:]
+
+def broadcast_variables(sess, allreduce, worker):
+  #starts every replica from the initial weights of worker 0
+  variables = tf.trainable_variables()
+  values = sess.run(variables)
+  flat = allreduce.broadcast(worker, np.concatenate([np.ravel(value) for value in values]).astype(np.float32))
+  offset = 0
+  for variable, value in zip(variables, values):
+      variable.load(flat[offset:offset + value.size].reshape(value.shape), sess)
+      offset += value.size
+
+def run_worker(trainer, worker, num_workers, data_path, models_directory, steps, warmup, allreduce, results, classifier_checkpoint=None):
+  #one replica, models_directory None only measures throughput
+  module, placeholders, updates, step_fetches = build_replica(trainer)
+  data = module.Data(data_path, cache_bytes=PHRASE_CACHE_BYTES//num_workers)
+  batch_size = data.batch_size
+  batches_per_epoch = max(1, int(data.num_examples/(batch_size*num_workers)))
+  epochs = CLASSIFIER_EPOCHS if trainer == 'classifier' else GAN_EPOCHS
+  steps = batches_per_epoch*epochs if steps is None else steps
+  shard_data(data, worker, num_workers)
+
+  #the cores are split between the workers instead of every session claiming all of them
+  threads = max(1, (os.cpu_count() or 1)//num_workers)
+  sess = tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=2))
+  sess.run(tf.global_variables_initializer())
+  sess.run(tf.local_variables_initializer())
+  if worker == 0 and classifier_checkpoint is not None:
+      module.restore_classifier(sess, classifier_checkpoint)
+  broadcast_variables(sess, allreduce, worker)
+  batches = prefetch.Prefetcher(data)
+
+  accuracy_old = 0
+  if worker == 0 and models_directory is not None:
+      metrics_writer = metrics.MetricsWriter(models_directory, METRIC_COLUMNS[trainer])
+      checkpoint_manager = checkpoints.CheckpointManager(sess, models_directory)
+  progress = trange(steps, desc = 'Bar_desc', leave = True, disable = worker != 0)
+  for t in progress:
+      if t == warmup:
+          start = time.perf_counter()
+
+      if trainer == 'classifier':
+          data_batch, label_batch = batches.get_batch()
+          feed_dict = {placeholders['real_data']: data_batch, placeholders['real_data_labels']: label_batch}
+          step_updates = updates
+      else:
+          discriminator_labels_real_batch, discriminator_labels_fake_batch = data.get_labels()
+          feed_dict = {placeholders['input_genre']: data.get_genre(), placeholders['latent_vector']: data.get_noise(), placeholders['real_data']: batches.get_batch(),
+                       placeholders['discriminator_labels_real']: discriminator_labels_real_batch, placeholders['discriminator_labels_fake']: discriminator_labels_fake_batch}
+          #the discriminator only trains every G_D_ASPECT_RATIO steps, like the single process loop
+          step_updates = updates if t%G_D_ASPECT_RATIO == 0 else updates[:1]
+      values = synchronous_step(sess, allreduce, worker, step_updates, step_fetches, feed_dict)
+
+      if worker != 0 or models_directory is None:
+          continue
+      progress.set_description(' '.join(str(value) for value in values))
+      metrics_writer.add(*values)
+      if t%batches_per_epoch == 0 or t == steps - 1:
+          print("Epoch Completed")
+          metrics_writer.flush()
+          print(batches.wait_summary())
+          accuracy = values[1] if trainer == 'classifier' else values[2]
+          #the classifier only keeps improvements, the GAN keeps every epoch
+          if trainer == 'gan' or accuracy > accuracy_old:
+              accuracy_old = max(accuracy, accuracy_old)
+              filename = "model-" + str((t*batch_size*num_workers)/data.num_examples) + "-" + str(accuracy)
+              checkpoint_manager.save(filename, accuracy)
+              print(checkpoint_manager.summary())
+
+  if worker == 0 and models_directory is not None:
+      metrics_writer.close()
+      checkpoint_manager.close()
+  if worker == 0:
+      results.put(time.perf_counter() - start if steps > warmup else 0.0)
+  batches.close()
+  sess.close()
+
+def launch(trainer, data_path, models_directory, num_workers, steps=None, warmup=0, classifier_checkpoint=None):
+  #runs num_workers replicas to the end and returns the seconds worker 0 took after the warmup steps
+  context = multiprocessing.get_context('spawn')
+  allreduce = AllReduce(num_workers, replica_size(trainer), context)
+  results = context.Queue()
+  workers = [context.Process(target=run_worker, args=(trainer, worker, num_workers, data_path, models_directory, steps, warmup, allreduce, results, classifier_checkpoint)) for worker in range(num_workers)]
+  for process in workers:
+      process.start()
+
+  #a worker that dies would leave the others waiting at the barrier forever
+  while any(process.is_alive() for process in workers):
+      if any(process.exitcode not in (None, 0) for process in workers):
+          for process in workers:
+              process.terminate()
+          raise RuntimeError(trainer + " worker failed with exit codes " + str([process.exitcode for process in workers]))
+      time.sleep(1)
+  if any(process.exitcode != 0 for process in workers):
+      raise RuntimeError(trainer + " worker failed with exit codes " + str([process.exitcode for process in workers]))
+  return results.get()
+
+def train(trainer, data_path, models_root, num_workers=DATA_PARALLEL_WORKERS, classifier_checkpoint=None):
+  #classifier_checkpoint is a trained classifier run loaded into the GAN's classifier
+  models_directory = join(models_root, ("saved_models_" + datetime.now().strftime('%Y-%m-%d_%H:%M:%S')))
+  os.makedirs(models_directory, exist_ok=True)
+  print("Training " + trainer + " on " + str(num_workers) + " workers, saving to " + models_directory)
+  if trainer == 'gan' and classifier_checkpoint is None:
+      print("No classifier checkpoint given, the classifier starts untrained")
+  launch(trainer, data_path, models_directory, num_workers, classifier_checkpoint=classifier_checkpoint)
+
+def scaling(trainer, data_path, worker_counts=SCALING_WORKERS, steps=20, warmup=3):
+  #samples/sec (real phrases per second) of synchronous training at every worker count
+  batch_size = BATCH_SIZE if trainer == 'classifier' else REAL_DATA_BATCH_SIZE
+  throughput = {}
+  for num_workers in worker_counts:
+      seconds = launch(trainer, data_path, None, num_workers, steps + warmup, warmup)
+      throughput[num_workers] = num_workers*batch_size*steps/seconds
+      print("SCALING ===> " + str(num_workers) + " workers: " + str(round(throughput[num_workers], 2)) + " samples/sec, " + str(round(throughput[num_workers]/throughput[worker_counts[0]], 2)) + "x")
+  return throughput
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Synchronous data-parallel training over worker processes")
+  parser.add_argument("command", choices=["train", "scaling"])
+  parser.add_argument("trainer", choices=sorted(TRAINERS))
+  parser.add_argument("data_directory")
+  parser.add_argument("models_directory", nargs="?", help="where train writes Model.csv and checkpoints")
+  parser.add_argument("-w", "--workers", type=int, nargs="+", default=None, help="worker count for train, worker counts for scaling")
+  parser.add_argument("-s", "--steps", type=int, default=20, help="measured steps per worker count for scaling")
+  parser.add_argument("-c", "--classifier-checkpoint", help="directory of a trained classifier run whose weights are loaded into the GAN's classifier")
+  args = parser.parse_args()
+
+  if args.classifier_checkpoint is not None and args.trainer != 'gan':
+      parser.error("--classifier-checkpoint only applies to the gan trainer")
+
+  if args.command == "train":
+      if args.models_directory is None:
+          parser.error("train needs a models_directory")
+      train(args.trainer, abspath(args.data_directory), args.models_directory, args.workers[0] if args.workers else DATA_PARALLEL_WORKERS, args.classifier_checkpoint)
+  else:
+      scaling(args.trainer, abspath(args.data_directory), args.workers or SCALING_WORKERS, args.steps)
+
+if __name__ == '__main__':
+  main()
@@ -1,59 +1,266 @@
 import pypianoroll
 import os, sys
+import argparse
+import json
+import time
+from tqdm import tqdm
+from multiprocessing import Pool
 from os.path import dirname, abspath, basename, exists, splitext, join
 import numpy as np
+from scipy.sparse import csc_matrix
 from CONFIG import *
+import phrase_store
+import phrase_index
 
 BEATS_PER_SET = BEATS_PER_BAR*NUM_BARS
+MAX_IN_FLIGHT_PHRASES = 64
 
-def parse_data(genres_directory, parsed_directory):
+def slice_phrases_loop(pianorolls):
+    #reference implementation: builds every phrase one beat at a time (kept for benchmarking)
+    song_divisions = int((pianorolls[0].size/TOTAL_PIANOROLL_NOTES)/BEATS_PER_SET)
+    phrases = []
+
+    for division in range(0, song_divisions):
+        track_list = []
+
+        for pianoroll in pianorolls:
+            current_beat = division*(BEATS_PER_SET)
+            bar_list = []
+
+            for bar in range(0, NUM_BARS):
+                beat_list = []
+
+                for beat in range(current_beat, current_beat+BEATS_PER_BAR):
+                    beat_list.append(np.asarray(pianoroll[beat][LOWEST_NOTE:LOWEST_NOTE+NUM_NOTES]))
+
+                bar_list.append(np.asarray(beat_list))
+                current_beat += BEATS_PER_BAR
+
+            track_list.append(np.asarray(bar_list))
+
+        phrases.append(np.reshape(np.asarray(track_list), (NUM_BARS, BEATS_PER_BAR, NUM_NOTES, NUM_TRACKS)))
+
+    return np.asarray(phrases)
+
+def stack_to_phrases(stacked):
+    #(NUM_TRACKS, divisions*BEATS_PER_SET, NUM_NOTES) -> (divisions, NUM_BARS, BEATS_PER_BAR, NUM_NOTES, NUM_TRACKS)
+    #keeps the (track, bar, beat, note) memory order of the loop so existing parsed data and convert_to_npz stay compatible
+    song_divisions = stacked.shape[1]//BEATS_PER_SET
+    phrases = np.reshape(stacked, (NUM_TRACKS, song_divisions, BEATS_PER_SET*NUM_NOTES)).transpose(1, 0, 2)
+    return np.reshape(phrases, (song_divisions, NUM_BARS, BEATS_PER_BAR, NUM_NOTES, NUM_TRACKS))
+
+def slice_phrases(pianorolls):
+    #stack the tracks once, crop the pitch window and cut the whole song into phrases in one step
+    stacked = np.stack([pianoroll[:, LOWEST_NOTE:LOWEST_NOTE+NUM_NOTES] for pianoroll in pianorolls])
+    song_divisions = stacked.shape[1]//BEATS_PER_SET
+    return stack_to_phrases(stacked[:, :song_divisions*BEATS_PER_SET])
+
+#STREAMING PIPELINE: load -> crop -> window -> describe -> encode -> write
+#tracks stay sparse until they are windowed, so only max_in_flight phrases are ever dense at once whatever the song
+#length, padding is applied to the last window only
+
+def load_tracks(song_path):
+    #every track of a pypianoroll npz as a sparse (time, pitch) matrix, read from the csc arrays pypianoroll.save writes
+    #instead of pypianoroll.load, which makes the whole song dense
+    with np.load(song_path) as loaded:
+        info = json.loads(loaded["info.json"].decode("utf-8"))
+        track = 0
+        while str(track) in info:
+            name = "pianoroll_" + str(track)
+            yield csc_matrix((loaded[name + "_csc_data"], loaded[name + "_csc_indices"], loaded[name + "_csc_indptr"]), shape=loaded[name + "_csc_shape"]).tocsr()
+            track += 1
+
+def crop_tracks(pianorolls):
+    #the pitch window of each sparse track
+    for pianoroll in pianorolls:
+        yield pianoroll[:, LOWEST_NOTE:LOWEST_NOTE+NUM_NOTES]
+
+def window_phrases(cropped, max_in_flight):
+    #yields the song in chunks of at most max_in_flight phrases, zero padding tracks to the same length and to a whole phrase
+    #the sparse tracks are held for the whole song, each chunk is made dense on its own
+    cropped = list(cropped)
+    song_length = max([pianoroll.shape[0] for pianoroll in cropped] + [0])
+    song_divisions = -(-song_length//BEATS_PER_SET)
+
+    for first in range(0, song_divisions, max_in_flight):
+        last = min(first + max_in_flight, song_divisions)
+        stacked = np.zeros((NUM_TRACKS, (last-first)*BEATS_PER_SET, NUM_NOTES), dtype=cropped[0].dtype)
+        for track, pianoroll in enumerate(cropped):
+            window = pianoroll[first*BEATS_PER_SET:last*BEATS_PER_SET].toarray()
+            stacked[track, :len(window)] = window
+        yield stack_to_phrases(stacked)
+
+def describe_phrases(phrase_chunks, metadata):
+    #collects the phrase index records of each chunk as it streams past
+    for phrases in phrase_chunks:
+        metadata.append(phrase_index.phrase_metadata(phrases))
+        yield phrases
+
+def encode_phrases(phrase_chunks, output_format):
+    #shard output is packed as it streams past, file formats are encoded by the writer
+    for phrases in phrase_chunks:
+        if output_format == "shards":
+            yield phrase_store.pack_phrases(phrases.astype(bool))
+        else:
+            yield phrases
+
+def write_phrases(encoded_chunks, song, genres, save_directory_path, output_format):
+    #writes phrase files (one per genre label) as they arrive, packed shard rows are collected and returned for the parent to store
+    packed_chunks = []
+    division = 0
+
+    for encoded in encoded_chunks:
+        if output_format == "shards":
+            packed_chunks.append(encoded)
+            continue
+
+        for phrase in encoded:
+            for genre in genres:
+                filename = genre + "-" + song.split(".")[0] + "-" + str(division)
+                filepath = join(save_directory_path, filename)
+
+                if output_format == "sparse":
+                    phrase_store.save_sparse_phrase(filepath, phrase, genre)
+                else:
+                    np.savez_compressed(filepath, data=np.asarray([phrase, genre], dtype=object))
+            division += 1
+
+    if output_format == "shards":
+        return np.concatenate(packed_chunks + [np.zeros((0, phrase_store.PHRASE_BYTES), dtype=np.uint8)])
+    return None
+
+def parse_song(song_path, genres, save_directory_path, output_format="npz", max_in_flight=MAX_IN_FLIGHT_PHRASES, song=None):
+    #parses one song once for all of its genres and returns a (manifest entry, genre, packed phrases, phrase index records) result per genre
+    #in shard format the packed phrases are returned for the parent to store, song names default to the song's filename
+    song = song or basename(song_path)
+    metadata = [np.zeros(0, dtype=phrase_index.INDEX_DTYPE)]
+    phrase_chunks = describe_phrases(window_phrases(crop_tracks(load_tracks(song_path)), max_in_flight), metadata)
+    packed_phrases = write_phrases(encode_phrases(phrase_chunks, output_format), song, genres, save_directory_path, output_format)
+    metadata = np.concatenate(metadata)
+
+    return [(genre + "/" + song, genre, packed_phrases, metadata) for genre in genres]
+
+def parse_song_job(job):
+    return parse_song(*job)
+
+class Manifest(object):
+    #list of songs that were fully parsed into npz phrases, so an interrupted run can pick up where it stopped
+    def __init__(self, save_directory_path):
+        manifest_path = join(save_directory_path, phrase_store.MANIFEST_FILENAME)
+        self.songs = phrase_store.read_songs(save_directory_path)
+        self.manifest = open(manifest_path, 'a')
+
+    def finished_songs(self):
+        return set(self.songs)
+
+    def add_song(self, song_entry, genre, packed_phrases):
+        #phrases are already on disk, a song is only listed once all of them are written
+        self.manifest.write(song_entry + "\n")
+        self.manifest.flush()
+        self.songs.append(song_entry)
+
+    def close(self):
+        self.manifest.close()
+
+def load_song_genres(genres_input):
+    #song path -> genres, from a folder of genre folders or from the genres manifest written by sorter
+    song_genres = {}
+
+    if os.path.isfile(genres_input):
+        with open(genres_input) as manifest:
+            song_genres = json.load(manifest)
+    else:
+        #a song copied into several genre folders is one entry with all of them, keyed on its filename
+        songs = {}
+        for genre in sorted(os.listdir(genres_input)):
+            genre_directory = join(genres_input, genre)
+            if not os.path.isdir(genre_directory):
+                continue
+            for song in os.listdir(genre_directory):
+                songs.setdefault(song, (join(genre_directory, song), []))[1].append(genre)
+        song_genres = dict(songs.values())
+
+    return song_genres
+
+def parse_data(genres_directory, parsed_directory, workers=1, output_format="npz", max_in_flight=MAX_IN_FLIGHT_PHRASES):
+    parse_songs(load_song_genres(genres_directory), parsed_directory, workers, output_format, max_in_flight)
+
+def parse_songs(song_genres, parsed_directory, workers=1, output_format="npz", max_in_flight=MAX_IN_FLIGHT_PHRASES, song_names=None):
+    #parses a {song path: genres} dict into the parsed directory, song_names can give songs a name other than their filename
+    song_names = song_names or {}
 
     save_directory_name = "NT-" + str(NUM_TRACKS) + "-NB-" + str(NUM_BARS) + "-BPB-" + str(BEATS_PER_BAR) + "-NN-" + str(NUM_NOTES)
+    if output_format == "shards":
+        save_directory_name += "-SHARDS"
+    elif output_format == "sparse":
+        save_directory_name += "-SPARSE"
     save_directory_path = join(parsed_directory, save_directory_name)
     os.makedirs(save_directory_path, exist_ok=True)
 
-    for genre in os.listdir(genres_directory):
-        if genre in GENRE_LIST:
-            print("\n\n\n\n")
-            print(genre)
-            print("\n\n\n\n")
-            genre_directory = join(genres_directory, genre)
-            for song in os.listdir(genre_directory):
-                print(song)
-                song_multitrack = pypianoroll.load(join(genre_directory, song))
-                song_multitrack.pad_to_same()
-                song_multitrack.pad_to_multiple(BEATS_PER_SET)
-                song_divisions = int(((song_multitrack.tracks[0].pianoroll.size)/128)/(BEATS_PER_SET))
+    #a shard store keeps its own list of committed songs, which doubles as the manifest
+    if output_format == "shards":
+        writer = phrase_store.ShardWriter(save_directory_path)
+    else:
+        writer = Manifest(save_directory_path)
+    finished_songs = writer.finished_songs()
+    index_writer = phrase_index.PhraseIndexWriter(save_directory_path)
+    jobs = []
+
+    #each song is parsed once, for whichever of its genres of interest are not parsed yet
+    for song_path, genres in song_genres.items():
+        song = song_names.get(song_path, basename(song_path))
+        genres = [genre for genre in genres if genre in GENRE_LIST and genre + "/" + song not in finished_songs]
+        if genres:
+            jobs.append((song_path, genres, save_directory_path, output_format, max_in_flight, song))
 
-                for division in range(0, song_divisions):
-                    track_list = []
+    print(str(len(finished_songs)) + " songs already parsed, " + str(len(jobs)) + " songs to parse")
 
-                    for track in song_multitrack.tracks:
-                        current_beat = division*(BEATS_PER_SET)
-                        bar_list = []
+    #a song is only added to the manifest once all of its phrases are written, so a killed run resumes at the first unfinished song
+    if workers > 1:
+        pool = Pool(workers)
+        parsed_songs = pool.imap_unordered(parse_song_job, jobs)
+    else:
+        pool = None
+        parsed_songs = map(parse_song_job, jobs)
 
-                        for bar in range(0, 4):
-                            beat_list = []
+    progress = tqdm(parsed_songs, total=len(jobs), desc='Parsing', unit='song')
+    start = time.time()
+    num_phrases = 0
 
-                            for beat in range(current_beat, current_beat+BEATS_PER_BAR):
-                                beat_list.append(np.asarray(track.pianoroll[beat][LOWEST_NOTE:LOWEST_NOTE+NUM_NOTES]))
+    try:
+        for parsed_genres in progress:
+            for song_entry, genre, packed_phrases, metadata in parsed_genres:
+                index_writer.add_song(len(writer.songs), metadata)
+                writer.add_song(song_entry, genre, packed_phrases)
+                num_phrases += len(metadata)
+            progress.set_postfix(phrases=num_phrases, phrases_per_sec=round(num_phrases/max(time.time() - start, 1e-6), 1))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        writer.close()
+        index_writer.close()
 
-                            bar_list.append(np.asarray(beat_list))
-                            current_beat += BEATS_PER_BAR
+    print("Parsed " + str(num_phrases) + " phrases in " + str(round(time.time() - start, 1)) + " seconds")
 
-                        track_list.append(np.asarray(bar_list))
 
-                    filename = genre + "-" + song.split(".")[0] + "-" + str(division)
-                    filepath = join(save_directory_path, filename)
+def parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('genres_directory', help='folder of genre folders or the <sorted folder>_genres_manifest.json from sorter')
+    parser.add_argument('parsed_directory')
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-f', '--format', choices=['npz', 'sparse', 'shards'], default='npz')
+    parser.add_argument('-m', '--max-in-flight', type=int, default=MAX_IN_FLIGHT_PHRASES)
 
-                    reshaped_track_list = np.reshape(np.asarray(track_list), (4, 96, 84, 5))
-                    np.savez_compressed(filepath, data=np.asarray([reshaped_track_list, genre]))
+    args = parser.parse_args()
 
+    return args
 
 def main():
-    genre_directory = abspath(sys.argv[1])
-    parsed_directory = abspath(sys.argv[2])
-    parse_data(genre_directory, parsed_directory)
+    args = parser()
+    genre_directory = abspath(args.genres_directory)
+    parsed_directory = abspath(args.parsed_directory)
+    parse_data(genre_directory, parsed_directory, args.workers, args.format, args.max_in_flight)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,205 @@
+import os, sys
+import time
+import shutil
+import argparse
+from os.path import abspath, isdir, exists, join
+import numpy as np
+import tensorflow as tf
+from CONFIG import *
+import phrase_store
+import generation_cache
+from class_conditional_musegan_GAN import Generator, convert_to_npz
+
+##Batched generation from a trained GAN checkpoint: python generate.py checkpoint output.npz -g 0 2 -n 1000
+##
+##Only the Generator is built, with placeholders of dynamic batch size, and its variables are restored from a GAN
+##checkpoint (a saved_models_<date> directory or one checkpoint path). Every phrase is named by its genre id and
+##an integer seed that fixes its latent vector, so the same (checkpoint, genre, seed) always gives the same phrase.
+##Phrases are binarized by rounding on the device like the songs rendered during training, or by sampling every cell
+##with the generated probability ('bernoulli', seeded by the phrase seed too). They are written bit-packed to one npz
+##next to their genres and seeds, and rendered as pypianoroll files (and MIDI, WAV and SVG with --render) with --songs.
+##With --cache phrases and rendered files already in a generation_cache are reused instead of run or rendered again.
+
+BINARIZE_MODES = ['round', 'bernoulli']
+RENDER_EXTENSIONS = ['mid', 'wav', 'svg']
+
+
+def checkpoint_path(checkpoint):
+    #a run directory resolves to its newest checkpoint
+    if isdir(checkpoint):
+        path = tf.train.latest_checkpoint(checkpoint)
+        if path is None:
+            raise ValueError("No checkpoint in " + checkpoint)
+        return path
+    return checkpoint
+
+def latent_vectors(seeds):
+    #one latent vector per seed, independent of which other phrases share its batch
+    return np.asarray([np.random.RandomState(seed).randn(LATENT_SIZE) for seed in seeds], dtype=np.float32)
+
+def sample_phrases(probabilities, seeds):
+    #bernoulli binarization, the uniforms of a phrase continue the random stream its latent vector was drawn from
+    phrases = np.empty(probabilities.shape, dtype=bool)
+    for ii in range(len(seeds)):
+        random = np.random.RandomState(seeds[ii])
+        random.randn(LATENT_SIZE)
+        phrases[ii] = random.rand(*probabilities.shape[1:]) < probabilities[ii]
+    return phrases
+
+
+class PhraseGenerator(object):
+  def __init__(self, checkpoint, batch_size=GENERATION_BATCH_SIZE, binarize=GENERATION_BINARIZE):
+    if binarize not in BINARIZE_MODES:
+        raise ValueError("binarize is one of " + ", ".join(BINARIZE_MODES))
+    self.checkpoint = checkpoint_path(checkpoint)
+    self.batch_size = batch_size
+    self.binarize = binarize
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+        self.input_genre = tf.placeholder(dtype = tf.int32, shape = [None])
+        self.latent_vector = tf.placeholder(dtype = tf.float32, shape = [None, LATENT_SIZE])
+        generator_out = Generator(self.input_genre, self.latent_vector, LATENT_SIZE, NUM_TRACKS, NUM_CLASSES)
+        #rounded phrases are fetched as bool, sampled ones need the probabilities
+        self.phrases = tf.cast(tf.round(generator_out), tf.bool) if binarize == 'round' else generator_out
+        #only the generator variables exist in this graph, the rest of the GAN checkpoint is skipped
+        saver = tf.train.Saver(tf.global_variables())
+    self.sess = tf.Session(graph=self.graph)
+    saver.restore(self.sess, self.checkpoint)
+
+  def run(self, genres, seeds):
+    #one sess.run over a whole batch, (N,) genre ids and seeds -> (N, 4, 96, 84, 5) bool
+    phrases = self.sess.run(self.phrases, feed_dict={self.input_genre: genres, self.latent_vector: latent_vectors(seeds)})
+    if self.binarize == 'bernoulli':
+        phrases = sample_phrases(phrases, seeds)
+    return phrases
+
+  def generate(self, genres, seeds):
+    #phrases for paired genre ids and seeds, in batches of at most batch_size
+    genres = np.asarray(genres, dtype=np.int32)
+    seeds = np.asarray(seeds, dtype=np.int64)
+    if len(genres) != len(seeds):
+        raise ValueError("Every phrase needs one genre id and one seed")
+    if np.any(genres < 0) or np.any(genres >= NUM_CLASSES):
+        raise ValueError("Genre ids have to be between 0 and " + str(NUM_CLASSES - 1))
+
+    phrases = np.empty((len(genres), NUM_BARS, BEATS_PER_BAR, NUM_NOTES, NUM_TRACKS), dtype=bool)
+    for start in range(0, len(genres), self.batch_size):
+        stop = min(start + self.batch_size, len(genres))
+        phrases[start:stop] = self.run(genres[start:stop], seeds[start:stop])
+    return phrases
+
+  def close(self):
+    self.sess.close()
+
+
+def generation_requests(genres, count, first_seed):
+    #count seeds per genre id, first_seed onwards for every genre
+    seeds = np.arange(first_seed, first_seed + count, dtype=np.int64)
+    return np.repeat(np.asarray(genres, dtype=np.int32), count), np.tile(seeds, len(genres))
+
+def save_phrases(path, phrases, genres, seeds):
+    np.savez(path, phrases=phrase_store.pack_phrases(phrases), genres=genres, seeds=seeds)
+
+def load_phrases(path):
+    #(phrases, genres, seeds) of a file written by save_phrases
+    with np.load(path) as phrase_file:
+        return phrase_store.unpack_phrases(phrase_file["phrases"]), phrase_file["genres"], phrase_file["seeds"]
+
+def render_phrase(phrase, directory, name, extensions):
+    #pypianoroll npz of a phrase plus the MIDI, WAV (FluidSynth, needs SOUNDFONT_PATH) or SVG files asked for
+    convert_to_npz(phrase, directory, name)
+    path = join(directory, name)
+    if not extensions:
+        return
+    import pypianoroll
+    multitrack = pypianoroll.load(path + ".npz")
+    if 'mid' in extensions or 'wav' in extensions:
+        pypianoroll.write(multitrack, path + ".mid")
+    if 'wav' in extensions:
+        from midi2audio import FluidSynth
+        FluidSynth(SOUNDFONT_PATH).midi_to_audio(path + ".mid", path + ".wav")
+        if 'mid' not in extensions:
+            os.remove(path + ".mid")
+    if 'svg' in extensions:
+        import matplotlib.pyplot as plt
+        from pypianoroll.plot import plot_multitrack
+        figure, axes = plot_multitrack(multitrack, filename=path + ".svg", preset="frame")
+        plt.close(figure)
+
+def render_songs(phrases, genres, seeds, directory, extensions, cache=None, keys=None):
+    #renders every phrase, files already in the cache are copied instead and new ones are added to it
+    for ii in range(len(phrases)):
+        name = GENRE_LIST[genres[ii]] + "_seed_" + str(seeds[ii])
+        needed = ['npz'] + list(extensions)
+        if cache is not None:
+            for extension in list(needed):
+                cached = cache.get_artifact(keys[ii], extension)
+                if cached is not None:
+                    shutil.copyfile(cached, join(directory, name + "." + extension))
+                    needed.remove(extension)
+        if not needed:
+            continue
+        render_phrase(phrases[ii], directory, name, [extension for extension in needed if extension != 'npz'])
+        if cache is not None:
+            for extension in needed:
+                if exists(join(directory, name + "." + extension)):
+                    cache.put_artifact(keys[ii], extension, join(directory, name + "." + extension))
+
+
+def parser():
+    parser = argparse.ArgumentParser(description="Generates phrases from a trained GAN checkpoint")
+    parser.add_argument('checkpoint', help='saved_models_<date> directory (its newest checkpoint) or a checkpoint path')
+    parser.add_argument('output', help='npz of the bit-packed phrases with their genre ids and seeds')
+    parser.add_argument('-g', '--genres', type=int, nargs='+', default=list(range(NUM_CLASSES)), help='genre ids, indices into GENRE_LIST')
+    parser.add_argument('-n', '--count', type=int, default=GENERATION_BATCH_SIZE, help='phrases per genre')
+    parser.add_argument('-s', '--first-seed', type=int, default=0)
+    parser.add_argument('-b', '--batch-size', type=int, default=GENERATION_BATCH_SIZE)
+    parser.add_argument('--binarize', choices=BINARIZE_MODES, default=GENERATION_BINARIZE)
+    parser.add_argument('--songs', help='also render every phrase as a pypianoroll file in this directory')
+    parser.add_argument('--render', nargs='+', choices=RENDER_EXTENSIONS, default=[], help='files rendered next to the pypianoroll files in --songs')
+    parser.add_argument('--cache', help='generation_cache directory phrases and rendered files are reused from')
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    args = parser()
+    genres, seeds = generation_requests(args.genres, args.count, args.first_seed)
+
+    checkpoint = checkpoint_path(abspath(args.checkpoint))
+    phrases = np.empty((len(genres), NUM_BARS, BEATS_PER_BAR, NUM_NOTES, NUM_TRACKS), dtype=bool)
+    missing = np.arange(len(genres))
+    cache, keys = None, None
+    start = time.perf_counter()
+    if args.cache is not None:
+        cache = generation_cache.GenerationCache(abspath(args.cache))
+        checkpoint_digest = generation_cache.checkpoint_hash(checkpoint)
+        keys = [generation_cache.entry_key(checkpoint_digest, genre, seed, args.binarize) for genre, seed in zip(genres, seeds)]
+        missing = np.asarray([ii for ii in range(len(keys)) if cache.get_phrase(keys[ii], phrases[ii]) is None], dtype=np.int64)
+    cache_elapsed = time.perf_counter() - start
+
+    #TF is only started when some phrase is not cached
+    if len(missing):
+        generator = PhraseGenerator(checkpoint, args.batch_size, args.binarize)
+        #the first batch pays for graph optimization and device setup, it is not part of the throughput
+        generator.generate(genres[:1], seeds[:1])
+        start = time.perf_counter()
+        phrases[missing] = generator.generate(genres[missing], seeds[missing])
+        elapsed = time.perf_counter() - start
+        generator.close()
+        print("GENERATE ===> " + str(len(missing)) + " phrases in " + str(round(elapsed, 2)) + "s, " + str(round(len(missing)/elapsed, 1)) + " phrases/sec")
+    if cache is not None:
+        for ii in missing:
+            cache.put_phrase(keys[ii], phrases[ii])
+        print("GENERATE ===> " + str(len(genres) - len(missing)) + " phrases from the cache in " + str(round(cache_elapsed, 2)) + "s")
+
+    save_phrases(abspath(args.output), phrases, genres, seeds)
+    if args.songs is not None:
+        os.makedirs(args.songs, exist_ok=True)
+        render_songs(phrases, genres, seeds, abspath(args.songs), args.render, cache, keys)
+    if cache is not None:
+        print(cache.summary())
+
+if __name__ == '__main__':
+    main()
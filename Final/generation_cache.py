@@ -0,0 +1,131 @@
+import os
+import glob
+import hashlib
+import threading
+from collections import OrderedDict
+from os.path import basename, join
+import numpy as np
+from CONFIG import *
+import phrase_store
+
+##Disk cache of generated phrases and the files rendered from them, content addressed by what decides a phrase
+##
+##A generated phrase only depends on the checkpoint weights, its genre id, its seed and how it was binarized, so the
+##entry key is the sha256 of those four. The checkpoint is named by a hash of its .index and .data files rather than
+##its path, so a copied or renamed checkpoint shares entries and a retrained one with the same name does not. An entry
+##is a <key>.phrase file (the PHRASE_BYTES packed bits) plus any rendered <key>.mid, <key>.wav or <key>.svg.
+##Entries are evicted least recently used first once all of them together exceed budget_bytes; the use order
+##survives restarts through the modification times, which every hit refreshes.
+
+PHRASE_EXTENSION = "phrase"
+ARTIFACT_EXTENSIONS = ["npz", "mid", "wav", "svg"]
+
+
+def checkpoint_hash(checkpoint):
+    #sha256 of the files of a tf.train.Saver checkpoint
+    digest = hashlib.sha256()
+    for path in [checkpoint + ".index"] + sorted(glob.glob(checkpoint + ".data-*")):
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(2**20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+def entry_key(checkpoint_digest, genre, seed, binarize):
+    return hashlib.sha256((checkpoint_digest + "/" + str(int(genre)) + "/" + str(int(seed)) + "/" + binarize).encode('utf-8')).hexdigest()
+
+
+class GenerationCache(object):
+    def __init__(self, directory, budget_bytes=GENERATION_CACHE_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.path = directory
+        self.budget_bytes = budget_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        #key -> bytes on disk of every entry, least recently used first
+        files = {}
+        for path in glob.glob(join(directory, "*.*")):
+            if not path.endswith(".tmp"):
+                files.setdefault(basename(path).split(".")[0], []).append(path)
+        last_used = dict((key, max(os.path.getmtime(path) for path in paths)) for key, paths in files.items())
+        self.entries = OrderedDict((key, sum(os.path.getsize(path) for path in files[key])) for key in sorted(files, key=last_used.get))
+        self.bytes = sum(self.entries.values())
+
+    def filename(self, key, extension):
+        return join(self.path, key + "." + extension)
+
+    def touch(self, key):
+        self.entries.move_to_end(key)
+        os.utime(self.filename(key, PHRASE_EXTENSION))
+
+    def get_phrase(self, key, out=None):
+        #the cached bool phrase, or None
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            with open(self.filename(key, PHRASE_EXTENSION), 'rb') as file:
+                packed = np.frombuffer(file.read(), dtype=np.uint8)
+            self.touch(key)
+            self.hits += 1
+        return phrase_store.unpack_phrases(packed[np.newaxis], None if out is None else out[np.newaxis])[0]
+
+    def get_artifact(self, key, extension):
+        #path of a cached rendered file of a cached phrase, or None
+        with self.lock:
+            if key not in self.entries or not os.path.exists(self.filename(key, extension)):
+                return None
+            self.touch(key)
+            return self.filename(key, extension)
+
+    def write(self, key, extension, content):
+        #content is written under a temporary name and renamed, so readers never see half a file
+        temporary = self.filename(key, extension) + "." + str(os.getpid()) + ".tmp"
+        with open(temporary, 'wb') as file:
+            file.write(content)
+        os.replace(temporary, self.filename(key, extension))
+
+    def put_phrase(self, key, phrase):
+        packed = phrase_store.pack_phrases(phrase[np.newaxis])[0]
+        with self.lock:
+            if key in self.entries:
+                self.touch(key)
+                return
+            self.write(key, PHRASE_EXTENSION, packed.tobytes())
+            self.entries[key] = packed.nbytes
+            self.bytes += packed.nbytes
+            self.evict()
+
+    def put_artifact(self, key, extension, source_path):
+        #copies a file rendered from the phrase of key into its entry, the phrase has to be cached first
+        with open(source_path, 'rb') as file:
+            content = file.read()
+        with self.lock:
+            if key not in self.entries:
+                return
+            if os.path.exists(self.filename(key, extension)):
+                self.bytes -= os.path.getsize(self.filename(key, extension))
+                self.entries[key] -= os.path.getsize(self.filename(key, extension))
+            self.write(key, extension, content)
+            self.entries[key] += len(content)
+            self.bytes += len(content)
+            self.touch(key)
+            self.evict()
+
+    def evict(self):
+        #drops least recently used entries until the cache fits its budget, the newest entry always stays
+        while self.bytes > self.budget_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            for extension in [PHRASE_EXTENSION] + ARTIFACT_EXTENSIONS:
+                if os.path.exists(self.filename(key, extension)):
+                    os.remove(self.filename(key, extension))
+            self.bytes -= size
+            self.evictions += 1
+
+    def hit_rate(self):
+        return self.hits/max(self.hits + self.misses, 1)
+
+    def summary(self):
+        return "GENERATION CACHE ===> " + str(round(100*self.hit_rate(), 1)) + "% hits, " + str(len(self.entries)) + " phrases, " + str(round(self.bytes/2**20, 1)) + "MB, " + str(self.evictions) + " evictions"
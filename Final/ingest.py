@@ -0,0 +1,63 @@
+import os, sys
+import argparse
+import time
+from os.path import dirname, abspath, basename, exists, splitext, join
+from CONFIG import *
+import sorter
+import data_parser
+
+##Single pass ingest: scans the LPD and lastfm trees in place, resolves genres in memory and streams the
+##songs straight into parsed phrases. Replaces running sorter.flattenFiles, sorter.sorter and data_parser
+##one after another, none of which are needed since nothing is renamed, copied or written in between.
+
+def scan_files(root, extension, named_by_folder):
+    #recursive os.scandir walk yielding (song id, path)
+    #LPD files are named after the folder they sit in (as flattenFiles does), lastfm info files after themselves
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(extension):
+                    song_msd = basename(directory) if named_by_folder and directory != root else entry.name.split(".")[0]
+                    yield song_msd, entry.path
+
+def ingest(song_folder, info_folder, tags_file, parsed_directory, workers=1, output_format="npz", max_in_flight=data_parser.MAX_IN_FLIGHT_PHRASES):
+    start = time.time()
+    song_paths = dict(scan_files(song_folder, ".npz", True))
+    info_paths = dict(scan_files(info_folder, ".json", False))
+    print("Found " + str(len(song_paths)) + " songs and " + str(len(info_paths)) + " info files in " + str(round(time.time() - start, 1)) + " seconds")
+
+    #only songs that have both a pianoroll and an info file are tagged
+    start = time.time()
+    tag_index = sorter.index_tags(dict([(song_msd, info_paths[song_msd]) for song_msd in song_paths if song_msd in info_paths]))
+    genres = sorter.song_genres(tag_index, sorter.load_tags_list(tags_file))
+    print("Tagged " + str(len(genres)) + " songs in " + str(round(time.time() - start, 1)) + " seconds")
+
+    song_genres = dict([(song_paths[song_msd], song_genres) for song_msd, song_genres in genres.items()])
+    song_names = dict([(song_paths[song_msd], song_msd + ".npz") for song_msd in genres])
+    data_parser.parse_songs(song_genres, parsed_directory, workers, output_format, max_in_flight, song_names)
+
+
+def parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('song_folder')
+    parser.add_argument('info_folder')
+    parser.add_argument('tags_file')
+    parser.add_argument('parsed_directory')
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-f', '--format', choices=['npz', 'sparse', 'shards'], default='npz')
+    parser.add_argument('-m', '--max-in-flight', type=int, default=data_parser.MAX_IN_FLIGHT_PHRASES)
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    args = parser()
+    ingest(abspath(args.song_folder), abspath(args.info_folder), abspath(args.tags_file), abspath(args.parsed_directory), args.workers, args.format, args.max_in_flight)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import os
+import glob
+import time
+import queue
+import threading
+from os.path import join
+import numpy as np
+from CONFIG import *
+
+##Buffered training metrics written from a background thread
+##
+##Rows are kept in memory and handed to a writer thread every flush_steps rows or flush_seconds, so the training
+##thread never waits on the filesystem. Every flush writes one typed chunk (metrics-N.npy, a structured array
+##with a step column and one float32 column per metric) and appends the same rows to Model.csv as before.
+##flush() blocks until everything added so far is on disk, for epoch ends and for close(). A resumed run first
+##drops the rows logged after its checkpoint with truncate_metrics and continues the step column from there.
+
+CSV_FILENAME = "Model.csv"
+
+
+def chunk_filename(chunk):
+    return "metrics-" + str(chunk).zfill(5) + ".npy"
+
+def load_metrics(directory):
+    #every chunk of a run as one structured array, in step order
+    chunks = [np.load(path) for path in sorted(glob.glob(join(directory, "metrics-*.npy")))]
+    return np.concatenate(chunks) if chunks else None
+
+def truncate_metrics(directory, steps):
+    #keeps only the rows of the first steps steps, in one chunk and in Model.csv
+    rows = load_metrics(directory)
+    for path in glob.glob(join(directory, "metrics-*.npy")):
+        os.remove(path)
+    if rows is None:
+        return
+    rows = rows[rows['step'] < steps]
+    np.save(join(directory, chunk_filename(0)), rows)
+    with open(join(directory, CSV_FILENAME), 'w') as f:
+        f.writelines(",".join(str(row[column]) for column in rows.dtype.names[1:]) + "\n" for row in rows)
+
+
+class MetricsWriter(object):
+    def __init__(self, directory, columns, flush_steps=METRICS_FLUSH_STEPS, flush_seconds=METRICS_FLUSH_SECONDS, first_step=0):
+        self.directory = directory
+        self.dtype = np.dtype([('step', '<i8')] + [(column, '<f4') for column in columns])
+        self.flush_steps = flush_steps
+        self.flush_seconds = flush_seconds
+        self.rows = []
+        self.steps = first_step
+        self.chunk = len(glob.glob(join(directory, "metrics-*.npy")))
+        self.last_flush = time.time()
+        self.error = None
+
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self.write_chunks, daemon=True)
+        self.thread.start()
+
+    def add(self, *values):
+        #one row of metric values, in column order
+        if self.error is not None:
+            raise self.error
+        self.rows.append((self.steps,) + tuple(values))
+        self.steps += 1
+        if len(self.rows) >= self.flush_steps or time.time() - self.last_flush >= self.flush_seconds:
+            self.submit()
+
+    def submit(self):
+        if self.rows:
+            self.pending.put(self.rows)
+        self.rows = []
+        self.last_flush = time.time()
+
+    def write_chunks(self):
+        while True:
+            rows = self.pending.get()
+            try:
+                if rows is not None and self.error is None:
+                    self.write(rows)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.pending.task_done()
+            if rows is None:
+                return
+
+    def write(self, rows):
+        chunk = np.array(rows, dtype=self.dtype)
+        np.save(join(self.directory, chunk_filename(self.chunk)), chunk)
+        self.chunk += 1
+
+        with open(join(self.directory, CSV_FILENAME), 'a') as f:
+            f.writelines(",".join(str(value) for value in row[1:]) + "\n" for row in rows)
+
+    def flush(self):
+        #waits until every row added so far is written
+        self.submit()
+        self.pending.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.flush()
+        self.pending.put(None)
+        self.thread.join()
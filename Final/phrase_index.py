@@ -0,0 +1,108 @@
+import os, sys
+from os.path import dirname, abspath, basename, exists, splitext, join
+import numpy as np
+from CONFIG import *
+import phrase_store
+
+##Per-phrase metadata index written by data_parser next to the parsed phrases
+##
+##phrase_index_v2.bin holds one INDEX_DTYPE record per phrase in the order songs were committed, so for a shard
+##store record i describes store phrase i. Records are appended before their song is committed to the
+##manifest (or the store's songs.txt), and records of uncommitted songs are dropped when the index is opened.
+##Statistics are taken in the (track, bar, beat, note) order the phrase was sliced in, the same order
+##convert_to_npz uses to rebuild the pianoroll, so they describe the actual instruments of the song.
+##A note is counted once at its onset, a cell that is on where the time step before it is off (or at the first step
+##of the phrase), so a held note counts as one note however long it lasts.
+
+#v2 counts onsets in 'notes', a phrase_index.bin counted active (time, pitch) cells and is not read
+PHRASE_INDEX_FILENAME = "phrase_index_v2.bin"
+
+INDEX_DTYPE = np.dtype([('song', '<i4'), ('division', '<i4'),
+                        ('notes', '<i4', (NUM_TRACKS,)),
+                        ('empty_bars', '?', (NUM_TRACKS, NUM_BARS)),
+                        ('pitch_classes', '<i4', (12,))])
+
+#pitch class of each row of the cropped note window
+PITCH_CLASS_MATRIX = np.eye(12, dtype=np.int32)[(LOWEST_NOTE + np.arange(NUM_NOTES)) % 12]
+
+
+def has_phrase_index(directory):
+    return exists(join(directory, PHRASE_INDEX_FILENAME))
+
+def phrase_metadata(phrases):
+    #index records (without song id) for a chunk of (N, 4, 96, 84, 5) phrases
+    tracks = np.reshape(phrases, (len(phrases), NUM_TRACKS, NUM_BARS, BEATS_PER_BAR, NUM_NOTES)) != 0
+    #(phrase, track, time, note), time running across the bars
+    steps = np.reshape(tracks, (len(phrases), NUM_TRACKS, NUM_BARS*BEATS_PER_BAR, NUM_NOTES))
+    onsets = steps.copy()
+    onsets[:, :, 1:] &= ~steps[:, :, :-1]
+
+    records = np.zeros(len(phrases), dtype=INDEX_DTYPE)
+    records['notes'] = onsets.sum(axis=(2, 3))
+    records['empty_bars'] = ~tracks.any(axis=(3, 4))
+    records['pitch_classes'] = np.dot(tracks.sum(axis=(1, 2, 3)), PITCH_CLASS_MATRIX)
+    return records
+
+def read_records(directory):
+    songs = phrase_store.read_songs(directory)
+    records = np.zeros(0, dtype=INDEX_DTYPE)
+    if has_phrase_index(directory):
+        records = np.fromfile(join(directory, PHRASE_INDEX_FILENAME), dtype=INDEX_DTYPE)
+
+    #drop records of a song that never got committed
+    committed = np.searchsorted(records['song'], len(songs))
+    return songs, records[:committed]
+
+
+class PhraseIndexWriter(object):
+    def __init__(self, directory):
+        songs, records = read_records(directory)
+
+        #a directory parsed before the index existed would end up with a partial index, so it is left without one
+        if songs and not has_phrase_index(directory):
+            print("No phrase index in " + directory + ", parsing without one")
+            self.index_file = None
+            return
+
+        #cut off anything an interrupted run wrote past the last committed song
+        self.index_file = open(join(directory, PHRASE_INDEX_FILENAME), 'ab')
+        self.index_file.truncate(len(records)*INDEX_DTYPE.itemsize)
+
+    def add_song(self, song_id, records):
+        #must be called before the song is committed to its manifest
+        if self.index_file is None:
+            return
+        records = records.copy()
+        records['song'] = song_id
+        records['division'] = np.arange(len(records))
+        self.index_file.write(records.tobytes())
+        self.index_file.flush()
+
+    def close(self):
+        if self.index_file is not None:
+            self.index_file.close()
+
+
+def load_phrase_index(directory):
+    #columnar view of the index: one array per column, one row per phrase
+    songs, records = read_records(directory)
+    song_entries = np.asarray(songs + [""])[records['song']]
+    genres = np.asarray([entry.split("/")[0] for entry in songs] + [""])[records['song']]
+    song_names = np.asarray([entry.split("/", 1)[-1].split(".")[0] for entry in songs] + [""])[records['song']]
+
+    return {
+        'genre': genres,
+        'song': song_entries,
+        'division': records['division'],
+        'filename': np.asarray([genre + "-" + song + "-" + str(division) + ".npz" for genre, song, division in zip(genres, song_names, records['division'])]),
+        'notes': records['notes'],
+        'empty_bars': records['empty_bars'],
+        'pitch_classes': records['pitch_classes'],
+    }
+
+def phrase_filter(index, min_notes=0, max_empty_bars=None):
+    #boolean mask of phrases with at least min_notes note onsets and at most max_empty_bars empty (track, bar) pairs
+    keep = index['notes'].sum(axis=1) >= min_notes
+    if max_empty_bars is not None:
+        keep &= index['empty_bars'].sum(axis=(1, 2)) <= max_empty_bars
+    return keep
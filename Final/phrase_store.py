@@ -0,0 +1,286 @@
+import os, sys
+import json
+import threading
+from collections import OrderedDict
+from os.path import dirname, abspath, basename, exists, splitext, join
+import numpy as np
+from CONFIG import *
+
+##Stored phrase formats: a sparse one-file-per-phrase encoding and a bit-packed, sharded phrase store
+##
+##Sparse phrase files hold the flat positions of the set cells of a phrase ("indices") and its genre, since
+##well under 1% of the cells of a phrase are set. load_phrase reads them as well as the original dense files.
+##
+##Every phrase is packed with np.packbits into a fixed stride row of a large shard file, so a batch is read
+##through np.memmap with no per-phrase file opens or zlib inflation. A store directory holds:
+##  store.json    phrase shape, shard size and the genre names used by the index
+##  songs.txt     one "genre/song" entry per committed song, the line number is the song id
+##  index.bin     one INDEX_DTYPE record per phrase (shard, row, genre id, song id, division)
+##  shard-N.bin   PHRASES_PER_SHARD rows of PHRASE_BYTES packed bits
+##
+##A song is committed by appending its songs.txt entry after its rows and index records are written, so
+##records of a song that was interrupted half way are dropped when the store is reopened.
+
+PHRASE_SHAPE = (NUM_BARS, BEATS_PER_BAR, NUM_NOTES, NUM_TRACKS)
+PHRASE_BITS = NUM_BARS*BEATS_PER_BAR*NUM_NOTES*NUM_TRACKS
+PHRASE_BYTES = (PHRASE_BITS + 7)//8
+PHRASES_PER_SHARD = 8192
+
+INDEX_DTYPE = np.dtype([('shard', '<i4'), ('row', '<i4'), ('genre', '<i2'), ('song', '<i4'), ('division', '<i4')])
+
+MANIFEST_FILENAME = "manifest.txt"
+STORE_FILENAME = "store.json"
+SONGS_FILENAME = "songs.txt"
+INDEX_FILENAME = "index.bin"
+
+
+def shard_filename(shard):
+    return "shard-" + str(shard).zfill(5) + ".bin"
+
+def is_store(directory):
+    return exists(join(directory, STORE_FILENAME))
+
+def read_songs(directory):
+    #committed "genre/song" entries of a parsed directory (its manifest) or of a shard store
+    songs_path = join(directory, SONGS_FILENAME if is_store(directory) else MANIFEST_FILENAME)
+    if not exists(songs_path):
+        return []
+    with open(songs_path) as file:
+        return file.read().splitlines()
+
+def pack_phrases(phrases):
+    #(N, 4, 96, 84, 5) bool -> (N, PHRASE_BYTES) uint8
+    return np.packbits(np.reshape(phrases, (len(phrases), PHRASE_BITS)), axis=1)
+
+def unpack_phrases(packed, out=None):
+    #(N, PHRASE_BYTES) uint8 -> (N, 4, 96, 84, 5) bool, written into out when it is given
+    if out is None:
+        out = np.empty((len(packed),) + PHRASE_SHAPE, dtype=bool)
+    out.reshape(len(packed), PHRASE_BITS)[:] = np.unpackbits(packed, axis=1)[:, :PHRASE_BITS]
+    return out
+
+def encode_sparse(phrase):
+    #flat positions of the set cells of a phrase, a phrase has PHRASE_BITS < 2**32 cells so uint32 is enough
+    return np.flatnonzero(np.reshape(phrase, PHRASE_BITS)).astype(np.uint32)
+
+def save_sparse_phrase(filepath, phrase, genre):
+    #sorted positions compress far better than the dense tensor and the genre is stored without pickling
+    np.savez_compressed(filepath, indices=encode_sparse(phrase), genre=np.asarray(genre))
+
+def load_phrase(filepath, out):
+    #densifies a sparse or dense phrase file straight into out (a preallocated phrase buffer) and returns its genre
+    with np.load(filepath, allow_pickle=True) as phrase_file:
+        if "indices" in phrase_file:
+            out[...] = False
+            out.reshape(PHRASE_BITS)[phrase_file["indices"]] = True
+            return str(phrase_file["genre"])
+
+        data = phrase_file["data"]
+        out[...] = data[0]
+        return data[1]
+
+def read_store_files(store_directory):
+    #returns the store settings, committed song entries and their index records
+    with open(join(store_directory, STORE_FILENAME)) as file:
+        settings = json.load(file)
+
+    if tuple(settings["phrase_shape"]) != PHRASE_SHAPE:
+        raise ValueError("Store phrase shape " + str(settings["phrase_shape"]) + " does not match CONFIG " + str(PHRASE_SHAPE))
+
+    songs = read_songs(store_directory)
+
+    index = np.zeros(0, dtype=INDEX_DTYPE)
+    if exists(join(store_directory, INDEX_FILENAME)):
+        index = np.fromfile(join(store_directory, INDEX_FILENAME), dtype=INDEX_DTYPE)
+
+    #drop records of a song that never got committed
+    committed = np.searchsorted(index['song'], len(songs))
+    return settings, songs, index[:committed]
+
+
+class ShardWriter(object):
+    def __init__(self, store_directory, phrases_per_shard=PHRASES_PER_SHARD):
+        os.makedirs(store_directory, exist_ok=True)
+        self.path = store_directory
+
+        if not is_store(store_directory):
+            self.settings = {"phrase_shape": list(PHRASE_SHAPE), "phrases_per_shard": phrases_per_shard, "genres": []}
+            self.write_settings()
+
+        self.settings, self.songs, index = read_store_files(store_directory)
+        self.phrases_per_shard = self.settings["phrases_per_shard"]
+        self.num_phrases = len(index)
+
+        #cut off anything an interrupted run wrote past the last committed song
+        with open(join(store_directory, INDEX_FILENAME), 'ab') as file:
+            file.truncate(self.num_phrases*INDEX_DTYPE.itemsize)
+        self.index_file = open(join(store_directory, INDEX_FILENAME), 'ab')
+        self.songs_file = open(join(store_directory, SONGS_FILENAME), 'a')
+        self.shard_file = None
+        self.shard = -1
+
+    def write_settings(self):
+        with open(join(self.path, STORE_FILENAME), 'w') as file:
+            json.dump(self.settings, file)
+
+    def finished_songs(self):
+        return set(self.songs)
+
+    def genre_id(self, genre):
+        if genre not in self.settings["genres"]:
+            self.settings["genres"].append(genre)
+            self.write_settings()
+        return self.settings["genres"].index(genre)
+
+    def open_shard(self, shard, row):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        self.shard = shard
+        shard_path = join(self.path, shard_filename(shard))
+        self.shard_file = open(shard_path, 'r+b' if exists(shard_path) else 'wb')
+        self.shard_file.truncate(row*PHRASE_BYTES)
+        self.shard_file.seek(row*PHRASE_BYTES)
+
+    def add_song(self, song_entry, genre, packed_phrases):
+        #writes the packed rows and index records of one song, then commits it
+        records = np.zeros(len(packed_phrases), dtype=INDEX_DTYPE)
+        records['genre'] = self.genre_id(genre)
+        records['song'] = len(self.songs)
+        records['division'] = np.arange(len(packed_phrases))
+
+        for ii in range(len(packed_phrases)):
+            shard, row = divmod(self.num_phrases, self.phrases_per_shard)
+            if shard != self.shard:
+                self.open_shard(shard, row)
+            self.shard_file.write(packed_phrases[ii].tobytes())
+            records['shard'][ii] = shard
+            records['row'][ii] = row
+            self.num_phrases += 1
+
+        if self.shard_file is not None:
+            self.shard_file.flush()
+        self.index_file.write(records.tobytes())
+        self.index_file.flush()
+        self.songs_file.write(song_entry + "\n")
+        self.songs_file.flush()
+        self.songs.append(song_entry)
+
+    def close(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        self.index_file.close()
+        self.songs_file.close()
+
+
+class PhraseStore(object):
+    def __init__(self, store_directory):
+        self.path = store_directory
+        self.settings, self.songs, self.index = read_store_files(store_directory)
+        self.genres = self.settings["genres"]
+        self.num_phrases = len(self.index)
+        self.shards = {}
+
+    def shard(self, shard):
+        #shards are memory mapped once and then reused for every batch
+        if shard not in self.shards:
+            shard_path = join(self.path, shard_filename(shard))
+            rows = os.path.getsize(shard_path)//PHRASE_BYTES
+            self.shards[shard] = np.memmap(shard_path, dtype=np.uint8, mode='r', shape=(rows, PHRASE_BYTES))
+        return self.shards[shard]
+
+    def genre_indices(self, genre):
+        #store indices of every phrase of a genre
+        if genre not in self.genres:
+            return np.zeros(0, dtype=np.int64)
+        return np.nonzero(self.index['genre'] == self.genres.index(genre))[0]
+
+    def genre_names(self, indices):
+        return [self.genres[genre] for genre in self.index['genre'][indices]]
+
+    def read_packed(self, indices):
+        records = self.index[np.asarray(indices)]
+        packed = np.empty((len(records), PHRASE_BYTES), dtype=np.uint8)
+        for shard in np.unique(records['shard']):
+            selected = np.nonzero(records['shard'] == shard)[0]
+            packed[selected] = self.shard(shard)[records['row'][selected]]
+        return packed
+
+    def read(self, indices, out=None):
+        return unpack_phrases(self.read_packed(indices), out)
+
+
+class PhraseCache(object):
+    #LRU cache of decoded phrases kept bit-packed (PHRASE_BYTES each) within a byte budget, shared by prefetch threads
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        #returns (packed phrase, genre) or None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, packed, genre):
+        if packed.nbytes > self.budget_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[0].nbytes
+            self.entries[key] = (packed, genre)
+            self.bytes += packed.nbytes
+
+            while self.bytes > self.budget_bytes:
+                evicted_packed, evicted_genre = self.entries.popitem(last=False)[1]
+                self.bytes -= evicted_packed.nbytes
+                self.evictions += 1
+
+    def hit_rate(self):
+        return self.hits/max(self.hits + self.misses, 1)
+
+    def summary(self):
+        return "CACHE ===> " + str(round(100*self.hit_rate(), 1)) + "% hits, " + str(len(self.entries)) + " phrases, " + str(round(self.bytes/2**20, 1)) + "MB, " + str(self.evictions) + " evictions"
+
+
+def convert_directory(parsed_directory, store_directory, phrases_per_shard=PHRASES_PER_SHARD):
+    #converts a directory of one-npz-per-phrase files ("genre-song-division.npz") into a shard store
+    songs = {}
+    for filename in os.listdir(parsed_directory):
+        if filename.endswith(".npz"):
+            genre, song_division = filename[:-len(".npz")].split("-", 1)
+            song, division = song_division.rsplit("-", 1)
+            songs.setdefault((genre, song), []).append((int(division), filename))
+
+    writer = ShardWriter(store_directory, phrases_per_shard)
+    finished_songs = writer.finished_songs()
+
+    for genre, song in sorted(songs):
+        #parsed files drop the extension of the LPD song they came from
+        song_entry = genre + "/" + song + ".npz"
+        if song_entry in finished_songs:
+            continue
+        print(song_entry)
+        phrase_files = [filename for division, filename in sorted(songs[(genre, song)])]
+        phrases = np.asarray([np.load(join(parsed_directory, filename), allow_pickle=True)["data"][0].astype(bool) for filename in phrase_files])
+        writer.add_song(song_entry, genre, pack_phrases(phrases))
+
+    writer.close()
+
+
+def main():
+    parsed_directory = abspath(sys.argv[1])
+    store_directory = abspath(sys.argv[2])
+    convert_directory(parsed_directory, store_directory)
+
+if __name__ == '__main__':
+    main()
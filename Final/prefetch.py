@@ -0,0 +1,59 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from CONFIG import *
+
+##Background batch prefetching for Data
+##
+##Batches are picked on the training thread with Data.next_batch_elements, in exactly the order Data.get_batch
+##would use, so shuffling and genre balancing are unchanged. Only decoding (Data.load_batch) runs on the thread
+##pool, and the next `depth` batches are decoded while the current training step runs. Each batch is decoded into
+##one of depth + 1 reused buffers, the extra one being the batch the training step is still feeding.
+##pending_rows lists the batches that were drawn but not yet returned, a resumed run passes them back as
+##resume_rows so no batch is skipped or repeated.
+
+class Prefetcher(object):
+  def __init__(self, data, depth=PREFETCH_BATCHES, workers=PREFETCH_WORKERS, resume_rows=()):
+    self.data = data
+    self.executor = ThreadPoolExecutor(workers)
+    self.pending = deque()
+    self.buffers = [data.new_batch_buffer() for ii in range(depth + 1)]
+    self.submitted = 0
+    self.wait_time = 0.0
+    self.batches = 0
+
+    #batches drawn before an interruption are decoded first, then new ones are drawn
+    self.resume_rows = list(resume_rows)
+    for ii in range(depth):
+        self.submit()
+
+  def submit(self):
+    #the buffer of the batch returned by the previous get_batch is free again once the caller asks for the next one
+    out = self.buffers[self.submitted % len(self.buffers)]
+    rows = self.resume_rows.pop(0) if self.resume_rows else self.data.next_batch_elements()
+    self.pending.append((rows, self.executor.submit(self.data.load_batch, rows, out)))
+    self.submitted += 1
+
+  def pending_rows(self):
+    #(genre id, file id) rows of the batches drawn from data but not returned yet, oldest first
+    return [rows.copy() for rows, future in self.pending] + [rows.copy() for rows in self.resume_rows]
+
+  def get_batch(self):
+    #returns the oldest prefetched batch and queues the next one, time spent blocking counts as data wait
+    start = time.perf_counter()
+    batch = self.pending.popleft()[1].result()
+    self.wait_time += time.perf_counter() - start
+    self.batches += 1
+
+    self.submit()
+    return batch
+
+  def wait_summary(self):
+    average = 1000*self.wait_time/max(self.batches, 1)
+    return "DATA WAIT ===> " + str(round(self.wait_time, 2)) + "s total, " + str(round(average, 2)) + "ms per batch over " + str(self.batches) + " batches"
+
+  def close(self):
+    #batches not started yet are dropped, the ones being decoded are waited for so no thread still writes a buffer
+    for rows, future in self.pending:
+        future.cancel()
+    self.executor.shutdown(wait=True)
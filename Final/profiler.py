@@ -0,0 +1,108 @@
+import os
+import time
+from os.path import join
+from collections import OrderedDict, deque
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+from CONFIG import *
+
+##Per-step profiling of a training loop
+##
+##Each step the loop wraps its phases (waiting for data, drawing noise and labels, sess.run, logging) in
+##profiler.phase(name). The last window steps of every phase are kept, and summary() reports their p50/p90/p99 in ms
+##next to the share of the step each phase takes. Every trace_every steps run_options() asks sess.run for a FULL_TRACE
+##RunMetadata, which write_trace saves as a Chrome trace (trace-step-N.json, open it in chrome://tracing) to see which
+##ops of the step dominate. A disabled profiler times nothing and never traces.
+
+PERCENTILES = [50, 90, 99]
+
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+class Phase(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.profiler.current[self.name] = self.profiler.current.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+class StepProfiler(object):
+    def __init__(self, directory, enabled=True, trace_every=PROFILE_TRACE_EVERY, window=PROFILE_WINDOW):
+        self.directory = directory
+        self.enabled = enabled
+        self.trace_every = trace_every
+        self.window = window
+        #phase name -> seconds of the last window steps, phases in the order they were first seen
+        self.phases = OrderedDict()
+        self.step_times = deque(maxlen=window)
+        self.current = {}
+        self.step_start = None
+        self.traces = 0
+        if enabled and trace_every:
+            os.makedirs(directory, exist_ok=True)
+
+    def phase(self, name):
+        #context manager timing one phase of the current step, a phase entered twice in a step adds up
+        if not self.enabled:
+            return NullPhase()
+        if self.step_start is None:
+            self.step_start = time.perf_counter()
+        return Phase(self, name)
+
+    def end_step(self):
+        if not self.enabled or self.step_start is None:
+            return
+        self.step_times.append(time.perf_counter() - self.step_start)
+        for name in self.current:
+            self.phases.setdefault(name, deque(maxlen=self.window))
+        #a phase a step skipped counts as 0 for that step
+        for name in self.phases:
+            self.phases[name].append(self.current.get(name, 0.0))
+        self.current = {}
+        self.step_start = None
+
+    def tracing(self, step):
+        return self.enabled and bool(self.trace_every) and step % self.trace_every == 0
+
+    def run_options(self, step):
+        #(options, run_metadata) for sess.run, both None on steps that are not traced
+        if not self.tracing(step):
+            return None, None
+        return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+    def write_trace(self, step, run_metadata):
+        if run_metadata is None:
+            return
+        trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+        with open(join(self.directory, "trace-step-" + str(step) + ".json"), 'w') as file:
+            file.write(trace)
+        self.traces += 1
+
+    def percentiles(self):
+        #phase name (and 'step') -> [p50, p90, p99] in ms
+        times = OrderedDict(self.phases)
+        times['step'] = self.step_times
+        return OrderedDict((name, list(1000*np.percentile(np.asarray(values), PERCENTILES))) for name, values in times.items() if len(values))
+
+    def summary(self):
+        if not self.enabled or not self.step_times:
+            return "PROFILE ===> no steps profiled"
+        total = sum(self.step_times)
+        lines = ["PROFILE ===> last " + str(len(self.step_times)) + " steps, p50/p90/p99 ms and share of step time, " + str(self.traces) + " traces in " + self.directory]
+        for name, values in self.percentiles().items():
+            share = "" if name == 'step' else "  " + str(round(100*sum(self.phases[name])/total, 1)) + "%"
+            lines.append("  " + name.ljust(12) + " " + " / ".join(str(round(value, 2)) for value in values) + share)
+        return "\n".join(lines)
@@ -0,0 +1,67 @@
+import numpy as np
+from CONFIG import *
+
+##Infinite genre-stratified sampling of (genre id, file id) rows for Data
+##
+##Every draw first picks a genre from the genre weights and then takes the next file id from that genre's own
+##permutation. A genre is reshuffled on its own when its cursor reaches the end, so every phrase is used once per
+##pass over its genre, no genre is truncated to the smallest one and there is no per-epoch rebuild of the whole list.
+
+def genre_weights(genre_files, weights=GENRE_WEIGHTS):
+    #normalized sampling probability of each genre id
+    counts = np.asarray([len(files) for files in genre_files], dtype=np.float64)
+    if isinstance(weights, str) and weights == 'balanced':
+        weights = (counts > 0).astype(np.float64)
+    elif isinstance(weights, str) and weights == 'proportional':
+        weights = counts
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.shape != counts.shape or (weights < 0).any():
+            raise ValueError("Genre weights need one non-negative weight per genre, got " + str(list(weights)))
+
+    if (weights[counts == 0] > 0).any() or weights.sum() == 0:
+        raise ValueError("Genres without phrases cannot be sampled: " + str(counts.astype(int).tolist()) + " phrases, weights " + str(weights.tolist()))
+    return weights/weights.sum()
+
+
+class GenreSampler(object):
+  def __init__(self, genre_files, weights=GENRE_WEIGHTS, seed=SAMPLER_SEED):
+    self.genre_files = [np.asarray(files, dtype=np.int64) for files in genre_files]
+    #the weights as given ('balanced', 'proportional' or one per genre), so a subset of the files can be weighted the same way
+    self.weight_spec = weights
+    self.weights = genre_weights(self.genre_files, weights)
+    self.seed = seed
+    self.random = np.random.RandomState(seed)
+    self.permutations = [self.random.permutation(files) for files in self.genre_files]
+    self.cursors = [0]*len(self.genre_files)
+
+  def take(self, genre_id, count):
+    #next count file ids of a genre, reshuffling the genre whenever its permutation runs out
+    chunks = []
+    while count > 0:
+        if self.cursors[genre_id] == len(self.permutations[genre_id]):
+            self.permutations[genre_id] = self.random.permutation(self.genre_files[genre_id])
+            self.cursors[genre_id] = 0
+        chunk = self.permutations[genre_id][self.cursors[genre_id]:self.cursors[genre_id] + count]
+        self.cursors[genre_id] += len(chunk)
+        count -= len(chunk)
+        chunks.append(chunk)
+    return np.concatenate(chunks)
+
+  def sample(self, count):
+    #(count, 2) int array of (genre id, file id) rows
+    samples = np.empty((count, 2), dtype=np.int64)
+    samples[:, 0] = self.random.choice(len(self.weights), size=count, p=self.weights)
+    for genre_id in np.unique(samples[:, 0]):
+        rows = np.nonzero(samples[:, 0] == genre_id)[0]
+        samples[rows, 1] = self.take(genre_id, len(rows))
+    return samples
+
+  def get_state(self):
+    #everything needed to continue the exact same sample order, see set_state
+    return {'permutations': [permutation.copy() for permutation in self.permutations], 'cursors': list(self.cursors), 'random': self.random.get_state()}
+
+  def set_state(self, state):
+    self.permutations = [permutation.copy() for permutation in state['permutations']]
+    self.cursors = list(state['cursors'])
+    self.random.set_state(state['random'])
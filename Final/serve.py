@@ -0,0 +1,283 @@
+import io
+import json
+import time
+import asyncio
+import argparse
+from os.path import abspath
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from CONFIG import *
+import phrase_store
+import generate
+import generation_cache
+
+##Local generation server: python serve.py checkpoint [--port 8765 | --unix /tmp/musegan.sock]
+##
+##Keeps one generator-only graph (generate.PhraseGenerator) loaded and answers HTTP requests on a TCP port or a
+##Unix socket. POST /generate with a JSON body {"genres": [...], "seeds": [...], "format": "npz" | "bool"} asks for
+##one phrase per genre (a GENRE_LIST name or id); seeds are optional and drawn by the server when missing.
+##The phrases of all requests waiting at a time are coalesced, whatever their genres, into one sess.run of at most
+##max_batch phrases, which runs once it is full or max_delay after the oldest waiting request arrived. "npz" answers
+##with the bytes of a generate.save_phrases file, "bool" with the raw (N, 4, 96, 84, 5) bool array and its seeds in
+##the X-Seeds header. GET /metrics reports p50/p99 request latency and how full the batches were. With --cache,
+##phrases found in a generation_cache answer without waiting for a batch and new ones are added to it.
+
+LATENCY_WINDOW = 10000 #latest requests the latency percentiles are taken over
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+class GenerationRequest(object):
+  def __init__(self, genres, seeds, future):
+    self.genres = genres
+    self.seeds = seeds
+    self.phrases = np.empty((len(genres),) + phrase_store.PHRASE_SHAPE, dtype=bool)
+    self.remaining = len(genres)
+    self.future = future
+    self.start = time.perf_counter()
+
+
+class Batcher(object):
+  #coalesces the phrases of concurrent requests into batches run on one generator thread
+  def __init__(self, generate_batch, max_batch=SERVER_MAX_BATCH, max_delay=SERVER_MAX_DELAY_MS/1000):
+    self.generate_batch = generate_batch
+    self.max_batch = max_batch
+    self.max_delay = max_delay
+    #(request, phrase index) of every phrase not run yet, oldest first
+    self.pending = deque()
+    self.wakeup = asyncio.Event()
+    self.executor = ThreadPoolExecutor(1)
+
+    self.latencies = deque(maxlen=LATENCY_WINDOW)
+    self.batch_sizes = []
+    self.requests = 0
+    self.generate_seconds = 0.0
+    self.started = time.perf_counter()
+
+  def submit(self, genres, seeds):
+    #future of the (N, 4, 96, 84, 5) phrases of one request
+    request = GenerationRequest(genres, seeds, asyncio.get_event_loop().create_future())
+    if len(genres) == 0:
+        request.future.set_result(request.phrases)
+        return request.future
+    self.pending.extend((request, index) for index in range(len(genres)))
+    self.wakeup.set()
+    return request.future
+
+  async def next_batch(self):
+    #waits for a first phrase, then for a full batch or the deadline of the oldest waiting request
+    while not self.pending:
+        self.wakeup.clear()
+        await self.wakeup.wait()
+    deadline = self.pending[0][0].start + self.max_delay
+    while len(self.pending) < self.max_batch and time.perf_counter() < deadline:
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), deadline - time.perf_counter())
+        except asyncio.TimeoutError:
+            break
+    return [self.pending.popleft() for ii in range(min(self.max_batch, len(self.pending)))]
+
+  async def run(self):
+    loop = asyncio.get_event_loop()
+    while True:
+        batch = await self.next_batch()
+        genres = np.asarray([request.genres[index] for request, index in batch], dtype=np.int32)
+        seeds = np.asarray([request.seeds[index] for request, index in batch], dtype=np.int64)
+
+        start = time.perf_counter()
+        try:
+            #requests keep arriving while the batch runs on the generator thread
+            phrases = await loop.run_in_executor(self.executor, self.generate_batch, genres, seeds)
+        except Exception as error:
+            for request, index in batch:
+                if not request.future.done():
+                    request.future.set_exception(error)
+            continue
+        self.generate_seconds += time.perf_counter() - start
+        self.batch_sizes.append(len(batch))
+
+        for (request, index), phrase in zip(batch, phrases):
+            request.phrases[index] = phrase
+            request.remaining -= 1
+            if request.remaining == 0 and not request.future.done():
+                request.future.set_result(request.phrases)
+                self.latencies.append(time.perf_counter() - request.start)
+                self.requests += 1
+
+  def metrics(self):
+    latencies = 1000*np.asarray(self.latencies)
+    batch_sizes = np.asarray(self.batch_sizes)
+    phrases = int(np.sum(batch_sizes))
+    return {'requests': self.requests,
+            'batches': len(batch_sizes),
+            'phrases': phrases,
+            'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'batch_fill': float(np.mean(batch_sizes)/self.max_batch) if len(batch_sizes) else None,
+            'full_batches': int(np.sum(batch_sizes == self.max_batch)),
+            'waiting_phrases': len(self.pending),
+            'generate_phrases_per_sec': phrases/self.generate_seconds if self.generate_seconds else None,
+            'uptime_sec': time.perf_counter() - self.started}
+
+  def summary(self):
+    metrics = self.metrics()
+    return "SERVER ===> " + str(metrics['requests']) + " requests, p50 " + str(metrics['latency_p50_ms']) + "ms, p99 " + str(metrics['latency_p99_ms']) + "ms, batch fill " + str(metrics['batch_fill'])
+
+
+def genre_id(genre):
+    #a GENRE_LIST name or an id
+    if isinstance(genre, str):
+        if genre not in GENRE_LIST:
+            raise ValueError("Unknown genre " + genre + ", expected one of " + ", ".join(GENRE_LIST))
+        return GENRE_LIST.index(genre)
+    if isinstance(genre, bool) or not isinstance(genre, int) or not 0 <= genre < NUM_CLASSES:
+        raise ValueError("Genre ids have to be integers between 0 and " + str(NUM_CLASSES - 1))
+    return genre
+
+class GenerationServer(object):
+  def __init__(self, batcher, seed=None, cache=None, cache_key=None):
+    self.batcher = batcher
+    self.random = np.random.RandomState(seed)
+    #cache_key(genre, seed) -> generation_cache entry key
+    self.cache = cache
+    self.cache_key = cache_key
+
+  async def phrases(self, genres, seeds):
+    if self.cache is None:
+        return await self.batcher.submit(genres, seeds)
+    keys = [self.cache_key(genre, seed) for genre, seed in zip(genres, seeds)]
+    phrases = np.empty((len(genres),) + phrase_store.PHRASE_SHAPE, dtype=bool)
+    missing = np.asarray([ii for ii in range(len(keys)) if self.cache.get_phrase(keys[ii], phrases[ii]) is None], dtype=np.int64)
+    if len(missing):
+        phrases[missing] = await self.batcher.submit(genres[missing], seeds[missing])
+        for ii in missing:
+            self.cache.put_phrase(keys[ii], phrases[ii])
+    return phrases
+
+  def parse_request(self, body):
+    #(genre ids, seeds, format) of a /generate body
+    request = json.loads(body.decode('utf-8'))
+    if not isinstance(request, dict) or not isinstance(request.get('genres'), list):
+        raise ValueError("The body needs a list of genres, one per phrase")
+    genres = np.asarray([genre_id(genre) for genre in request['genres']], dtype=np.int32)
+    if request.get('seeds') is None:
+        seeds = self.random.randint(2**31, size=len(genres)).astype(np.int64)
+    else:
+        seeds = np.asarray(request['seeds'], dtype=np.int64)
+        if seeds.shape != genres.shape:
+            raise ValueError("seeds needs one seed per genre")
+        if np.any(seeds < 0) or np.any(seeds >= 2**32):
+            raise ValueError("Seeds have to be between 0 and 2**32 - 1")
+    output_format = request.get('format', 'npz')
+    if output_format not in ('npz', 'bool'):
+        raise ValueError("format is 'npz' or 'bool'")
+    return genres, seeds, output_format
+
+  async def respond(self, method, target, body):
+    #(status, content type, content, extra headers)
+    if method == 'GET' and target == '/metrics':
+        return 200, 'application/json', json.dumps(self.batcher.metrics()).encode('utf-8'), {}
+    if method != 'POST' or target != '/generate':
+        return 404, 'text/plain', b"POST /generate or GET /metrics\n", {}
+
+    try:
+        genres, seeds, output_format = self.parse_request(body)
+    except ValueError as error:
+        return 400, 'text/plain', (str(error) + "\n").encode('utf-8'), {}
+
+    phrases = await self.phrases(genres, seeds)
+    if output_format == 'bool':
+        headers = {'X-Shape': ",".join(str(size) for size in phrases.shape), 'X-Seeds': ",".join(str(seed) for seed in seeds)}
+        return 200, 'application/octet-stream', phrases.tobytes(), headers
+    content = io.BytesIO()
+    generate.save_phrases(content, phrases, genres, seeds)
+    return 200, 'application/octet-stream', content.getvalue(), {}
+
+  async def handle(self, reader, writer):
+    #minimal HTTP/1.1 with keep-alive, one request at a time per connection
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            method, target = request_line.decode('latin-1').split()[:2]
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                name, value = line.decode('latin-1').split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            try:
+                status, content_type, content, extra_headers = await self.respond(method, target, body)
+            except Exception as error:
+                status, content_type, content, extra_headers = 500, 'text/plain', (str(error) + "\n").encode('utf-8'), {}
+            response_headers = dict({'Content-Type': content_type, 'Content-Length': str(len(content))}, **extra_headers)
+            writer.write(("HTTP/1.1 " + str(status) + " " + REASONS[status] + "\r\n" + "".join(name + ": " + value + "\r\n" for name, value in response_headers.items()) + "\r\n").encode('latin-1') + content)
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(generate_batch, host='127.0.0.1', port=SERVER_PORT, unix_path=None, max_batch=SERVER_MAX_BATCH, max_delay=SERVER_MAX_DELAY_MS/1000, cache=None, cache_key=None):
+    batcher = Batcher(generate_batch, max_batch, max_delay)
+    server = GenerationServer(batcher, cache=cache, cache_key=cache_key)
+    if unix_path is not None:
+        listener = await asyncio.start_unix_server(server.handle, path=unix_path)
+        print("Serving on " + unix_path)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+        print("Serving on http://" + host + ":" + str(port))
+    try:
+        await batcher.run()
+    finally:
+        listener.close()
+        print(batcher.summary())
+        if cache is not None:
+            print(cache.summary())
+
+
+def parser():
+    parser = argparse.ArgumentParser(description="Serves generated phrases from a trained GAN checkpoint")
+    parser.add_argument('checkpoint', help='saved_models_<date> directory (its newest checkpoint) or a checkpoint path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=SERVER_PORT)
+    parser.add_argument('-u', '--unix', help='listen on this Unix socket instead of a TCP port')
+    parser.add_argument('-b', '--max-batch', type=int, default=SERVER_MAX_BATCH, help='phrases per sess.run')
+    parser.add_argument('-d', '--max-delay-ms', type=float, default=SERVER_MAX_DELAY_MS, help='longest a request waits for its batch to fill')
+    parser.add_argument('--binarize', choices=generate.BINARIZE_MODES, default=GENERATION_BINARIZE)
+    parser.add_argument('--cache', help='generation_cache directory phrases are reused from')
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    args = parser()
+    generator = generate.PhraseGenerator(abspath(args.checkpoint), args.max_batch, args.binarize)
+    #the first batch pays for graph optimization and device setup, before any request waits on it
+    generator.generate([0], [0])
+
+    cache, cache_key = None, None
+    if args.cache is not None:
+        cache = generation_cache.GenerationCache(abspath(args.cache))
+        checkpoint_digest = generation_cache.checkpoint_hash(generator.checkpoint)
+        cache_key = lambda genre, seed: generation_cache.entry_key(checkpoint_digest, genre, seed, args.binarize)
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(serve(generator.run, args.host, args.port, args.unix, args.max_batch, args.max_delay_ms/1000, cache, cache_key))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        generator.close()
+
+if __name__ == '__main__':
+    main()
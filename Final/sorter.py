@@ -5,9 +5,15 @@ import os, sys
 from os.path import dirname, abspath, basename, exists, splitext
 from os.path import join as joinPath
 import json
+import hashlib
+import argparse
 from shutil import copyfile
+from concurrent.futures import ThreadPoolExecutor
 
 GENRE_AMOUNT = 100 #sorts only for 100 most popular genres in lastfm dataet
+TAG_INDEX_FILENAME = "tag_index.json" #cache of every song's tags, kept next to the info folder as <info folder>_tag_index.json
+TAG_INDEX_THREADS = 16 #reading info files is I/O bound
+GENRES_MANIFEST_FILENAME = "genres_manifest.json" #song path -> genres, written next to the sorted folder as <sorted folder>_genres_manifest.json
 
 def flattenFiles(here):
     for root, dirs, files in os.walk(here, topdown=False):
@@ -23,58 +29,139 @@ def flattenFiles(here):
             os.rmdir(joinPath(root, name))
 
 
-def sorter(song_folder, info_folder, sorted_folder, tags_file):
-    info_folder_list = os.listdir(info_folder)
+def read_tags(info_path):
+    #every tag (genre) of one info file, in lastfm order
+    with open(info_path) as info_json:
+        parsed_info = json.load(info_json)
+        return [tag[0] for tag in parsed_info['tags']]
 
+def index_tags(info_paths):
+    #song id -> all of its tags for a {song id: info file path} dict, the files are read with a thread pool
+    song_ids = list(info_paths)
+    with ThreadPoolExecutor(TAG_INDEX_THREADS) as executor:
+        tags = list(executor.map(read_tags, [info_paths[song_msd] for song_msd in song_ids]))
+    return dict(zip(song_ids, tags))
+
+def genres_manifest_path(sorted_folder):
+    #next to the sorted folder, which only holds genre folders
+    return joinPath(dirname(sorted_folder), basename(sorted_folder) + "_" + GENRES_MANIFEST_FILENAME)
+
+def tag_index_path(info_folder):
+    #outside the info folder, so the cache is not read as an info file, and outside the sorted folder of genre folders
+    return joinPath(dirname(info_folder), basename(info_folder) + "_" + TAG_INDEX_FILENAME)
+
+def info_fingerprint(info_folder, info_files):
+    #sha256 of the name, size and modification time of every info file, changes whenever one is added, removed or edited
+    digest = hashlib.sha256()
+    for name in sorted(info_files):
+        stat = os.stat(joinPath(info_folder, name))
+        digest.update((name + "/" + str(stat.st_size) + "/" + str(stat.st_mtime_ns) + "\n").encode('utf-8'))
+    return digest.hexdigest()
+
+def build_tag_index(info_folder, cache_path):
+    #maps every song id to all of its tags, reading the info files once and caching the result
+    info_files = [name for name in os.listdir(info_folder) if name.endswith(".json")]
+    fingerprint = info_fingerprint(info_folder, info_files)
+
+    if exists(cache_path):
+        with open(cache_path) as cache:
+            cached = json.load(cache)
+            if cached.get('fingerprint') == fingerprint:
+                return cached['tags']
+
+    tag_index = index_tags(dict([(name.split(".")[0], joinPath(info_folder, name)) for name in info_files]))
+
+    with open(cache_path, 'w') as cache:
+        json.dump({'fingerprint': fingerprint, 'tags': tag_index}, cache)
+
+    return tag_index
+
+def load_tags_list(tags_file):
     #import list of tags that are desired from stripped lastfm file
     with open(tags_file) as file:
-        tags_list = file.read().splitlines()
-        for i in tags_list:
-            tags_list[i] = tags_list[i].split(" ")[0]
-
-        tags_list = tags_list[:GENRE_AMOUNT]
+        tags_list = [line.split(" ")[0] for line in file.read().splitlines()]
+
+    return set(tags_list[:GENRE_AMOUNT])
+
+def song_genres(tag_index, tags_list):
+    #song id -> genre folder names of its desired tags, cleaned for placing into folders
+    genres = {}
+    for song_msd, tags in tag_index.items():
+        song_genre_list = [genre.lower().replace(" ", "_") for genre in tags if genre in tags_list]
+        if song_genre_list:
+            genres[song_msd] = list(dict.fromkeys(song_genre_list))
+    return genres
+
+def place_song(source, target, mode):
+    #puts a song in a genre folder by copying or linking it
+    if os.path.lexists(target):
+        os.remove(target)
+    if mode == "hardlink":
+        os.link(source, target)
+    elif mode == "symlink":
+        os.symlink(source, target)
+    else:
+        copyfile(source, target)
+
+def sorter(song_folder, info_folder, sorted_folder, tags_file, mode="copy"):
+    os.makedirs(sorted_folder, exist_ok=True)
+
+    #the tag index holds every tag, so sorting again with another GENRE_AMOUNT does not re-read the info files
+    tag_index = build_tag_index(info_folder, tag_index_path(info_folder))
+    genres = song_genres(tag_index, load_tags_list(tags_file))
+    genre_folders = set()
+    genres_manifest = {}
 
     #run through list of songs that we can from lpd_5_cleansed list that was stripped to only songs that we have info for usinf strip.py
     for file in os.listdir(song_folder):
-        #find corresponding info file for songs npz file
+        #find the desired genres of the corresponding info file, songs without one are skipped
         song_msd = file.split(".")[0]
-        song_msd = song_msd + ".json"
-        song_msd_path = joinPath(info_folder, song_msd)
+        source = joinPath(song_folder, file)
+
+        if song_msd in genres:
+            genres_manifest[source] = genres[song_msd]
+
+        #manifest mode leaves the songs where they are, data_parser reads the manifest instead
+        if mode == "manifest":
+            continue
+
+        for genre in genres.get(song_msd, []):
+            genre_folder_path = joinPath(sorted_folder, genre)
+
+            #make folder for genre if it doesnt exist
+            if genre not in genre_folders:
+                os.makedirs(genre_folder_path, exist_ok=True)
+                genre_folders.add(genre)
 
-        #check to see if there is an info file for the song that is being checked
-        if song_msd in info_folder_list:
-            #open json file
-            with open(song_msd_path) as info_json:
-                parsed_info = json.load(info_json)
-                #find tags (genres) from json file
-                info_tags = parsed_info['tags']
+            #copy (or link) each song to every desired genre's folder that it is tagged as
+            target = joinPath(genre_folder_path, file)
+            place_song(source, target, mode)
 
-                #check if current tag is part of desired tags list
-                for tag in info_tags:
-                    genre = tag[0]
+    #one entry per song with all of its genres (song path -> genres)
+    with open(genres_manifest_path(sorted_folder), 'w') as manifest:
+        json.dump(genres_manifest, manifest)
 
-                    if genre in tags_list:
-                        #clean genre string for placing into folders
-                        genre = genre.lower().replace(" ", "_")
-                        genre_folder_path = joinPath(sorted_folder, genre)
 
-                        #make folder for genre if it doesnt exist
-                        if not os.path.isdir(genre_folder_path):
-                            os.makedirs(genre_folder_path)
+def parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('song_folder')
+    parser.add_argument('info_folder')
+    parser.add_argument('sorted_folder')
+    parser.add_argument('tags_file')
+    parser.add_argument('-m', '--mode', choices=['copy', 'hardlink', 'symlink', 'manifest'], default='copy')
 
-                        #copy each song to every desired genre's folder that it is tagged as
-                        source = joinPath(song_folder, file)
-                        target = joinPath(genre_folder_path, file)
-                        copyfile(source, target)
+    args = parser.parse_args()
 
+    return args
 
 if __name__=='__main__':
-    song_folder = abspath(sys.argv[1])
-    info_folder = abspath(sys.argv[2])
-    sorted_folder = abspath(sys.argv[3])
-    tags_file = abspath(sys.argv[4])
+    args = parser()
+    song_folder = abspath(args.song_folder)
+    info_folder = abspath(args.info_folder)
+    sorted_folder = abspath(args.sorted_folder)
+    tags_file = abspath(args.tags_file)
 
     flattenFiles(song_folder)
     flattenFiles(info_folder)
 
-    sorter(song_folder, info_folder, sorted_folder, tags_file)
+    sorter(song_folder, info_folder, sorted_folder, tags_file, args.mode)
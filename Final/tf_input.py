@@ -0,0 +1,44 @@
+import numpy as np
+import tensorflow as tf
+from CONFIG import *
+import phrase_store
+
+##tf.data input pipeline over the phrases listed by a Data object
+##
+##Each genre's phrases (filenames, or store indices for a shard store) are shuffled and repeated on their own
+##and drawn from with the genre weights of data.sampler, so batches follow the same genre mix as Data.get_batch
+##without truncating the larger genres. Phrases are decoded in parallel with num_parallel_calls and batches are
+##prefetched on the TF side, so the training graph reads real data straight from the iterator.
+
+def decode_phrase(data, element):
+    #filenames arrive from TF as bytes, store indices as integers
+    phrase = np.empty(phrase_store.PHRASE_SHAPE, dtype=bool)
+    data.load_phrase(element if data.store is not None else element.decode(), phrase)
+    return phrase
+
+def phrase_dataset(data, batch_size, shuffle_buffer=TF_DATA_SHUFFLE_BUFFER, parallel_calls=TF_DATA_PARALLEL_CALLS, prefetch_batches=PREFETCH_BATCHES):
+    #genres without weight may have no phrases to repeat, so they are left out
+    genre_datasets = []
+    sampled = [genre_id for genre_id, weight in enumerate(data.sampler.weights) if weight > 0]
+    for genre_id in sampled:
+        elements = data.elements[data.genre_files[genre_id]]
+        labels = np.full(len(elements), genre_id, dtype=np.int32)
+        genre_dataset = tf.data.Dataset.from_tensor_slices((elements, labels))
+        genre_datasets.append(genre_dataset.shuffle(len(elements), seed=data.sampler.seed).repeat())
+
+    dataset = tf.data.experimental.sample_from_datasets(genre_datasets, data.sampler.weights[sampled], seed=data.sampler.seed)
+    dataset = dataset.shuffle(shuffle_buffer, seed=data.sampler.seed)
+
+    def decode(element, label):
+        phrase = tf.py_func(lambda element: decode_phrase(data, element), [element], tf.bool, stateful=False)
+        phrase.set_shape(phrase_store.PHRASE_SHAPE)
+        return phrase, label
+
+    dataset = dataset.map(decode, num_parallel_calls=parallel_calls)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    return dataset.prefetch(prefetch_batches)
+
+def make_input(data, batch_size):
+    #(bool phrases, int32 labels) batch tensors that advance every time they are evaluated
+    iterator = phrase_dataset(data, batch_size).make_one_shot_iterator()
+    return iterator.get_next()
@@ -0,0 +1,283 @@
+import os, sys
+import shutil
+import argparse
+from os.path import abspath, exists
+import numpy as np
+import tensorflow as tf
+from CONFIG import *
+import checkpoints
+
+##Private per-track layers with the track dimension batched
+##
+##Generator, Discriminator and Classifier give every track its own pitch-time, time-pitch and merging conv3d (or
+##conv3d_transpose) layers, built NUM_TRACKS times in a Python loop. With BATCHED_TRACKS each of these layers keeps the
+##weights of all tracks stacked in one variable (track axis first, every slice shaped like the per-track variable) and
+##runs as one op for all tracks. Every private layer has strides equal to its kernel size with VALID padding, so it is a
+##product of non-overlapping patches with the kernel: one batched matmul over a (tracks, positions, patch) tensor.
+##The sums are the same as the per-track convolutions but are not added in the same order (the convolution kernels
+##pick their own), so outputs are not bit-identical: they agree within EQUIVALENCE_TOLERANCE of the largest output,
+##which python track_layers.py check asserts. Batched variables are named <per-track layer name>_tracks,
+##convert_checkpoint stacks the per-track variables of a checkpoint (optimizer slots included) into them and back:
+##  python track_layers.py convert saved_models_<date>/model-3.0-0.9 converted/model-3.0-0.9 [--to per_track]
+##Checkpoints of the other layout loaded with optimistic_restore (the classifier of the GAN) are converted in memory.
+
+BATCHED_SUFFIX = "_tracks"
+BN_EPSILON = 1e-3 #tf.layers.batch_normalization default
+EQUIVALENCE_TOLERANCE = 1e-4 #largest batched vs per-track output difference, relative to the largest output (at least 1)
+
+GENERATOR_PRIVATE_LAYERS = ['generator_pt_conv3d_1', 'generator_pt_bn_1', 'generator_pt_conv3d_2', 'generator_pt_bn_2',
+                            'generator_tp_conv3d_1', 'generator_tp_bn_1', 'generator_tp_conv3d_2', 'generator_tp_bn_2',
+                            'generator_merged_conv3d', 'generator_merged_bn']
+CRITIC_PRIVATE_LAYERS = [model + layer for model in ['discriminator', 'classifier'] for layer in ['_pt_conv3d_1', '_pt_conv3d_2', '_tp_conv3d_1', '_tp_conv3d_2', '_merged_conv3d']]
+PRIVATE_LAYERS = GENERATOR_PRIVATE_LAYERS + CRITIC_PRIVATE_LAYERS
+
+
+def my_leaky_relu(x):
+    return tf.nn.leaky_relu(x, alpha=.5)
+
+def stacked_initializer(initializer):
+    #every track's slice is drawn like the variable of the per-track layer
+    def initialize(shape, dtype=tf.float32, partition_info=None):
+        shape = list(shape)
+        return tf.stack([initializer(shape[1:], dtype) for track in range(shape[0])])
+    return initialize
+
+def split_tracks(inputs):
+    #(B, D, H, W, T) -> (T, B, D, H, W, 1)
+    return tf.expand_dims(tf.transpose(inputs, [4, 0, 1, 2, 3]), -1)
+
+def merge_tracks(tracks):
+    #(T, B, D, H, W, C) -> (B, D, H, W, T*C), the channel order of concatenating the per-track outputs
+    num_tracks, batch, depth, height, width, channels = tracks.get_shape().as_list()
+    return tf.reshape(tf.transpose(tracks, [1, 2, 3, 4, 0, 5]), [-1, depth, height, width, num_tracks*channels])
+
+def to_patches(tracks, kernel_size):
+    #(T, B, D, H, W, C) -> (T, B*D'*H'*W', kd*kh*kw*C) non-overlapping patches in kernel order, and (D', H', W')
+    num_tracks, batch, depth, height, width, channels = tracks.get_shape().as_list()
+    kd, kh, kw = kernel_size
+    spatial = [depth//kd, height//kh, width//kw]
+    #a patch along the last spatial axis only is already contiguous
+    if kd > 1 or kh > 1:
+        tracks = tf.reshape(tracks, [num_tracks, -1, spatial[0], kd, spatial[1], kh, spatial[2], kw, channels])
+        tracks = tf.transpose(tracks, [0, 1, 2, 4, 6, 3, 5, 7, 8])
+    return tf.reshape(tracks, [num_tracks, -1, kd*kh*kw*channels]), spatial
+
+def from_patches(patches, spatial, kernel_size, channels):
+    #(T, B*D*H*W, kd*kh*kw*C) -> (T, B, D*kd, H*kh, W*kw, C), the inverse of to_patches
+    num_tracks = patches.get_shape().as_list()[0]
+    kd, kh, kw = kernel_size
+    if kd > 1 or kh > 1:
+        patches = tf.reshape(patches, [num_tracks, -1] + spatial + [kd, kh, kw, channels])
+        patches = tf.transpose(patches, [0, 1, 2, 5, 3, 6, 4, 7, 8])
+    return tf.reshape(patches, [num_tracks, -1, spatial[0]*kd, spatial[1]*kh, spatial[2]*kw, channels])
+
+def conv3d_tracks(tracks, filters, kernel_size, activation=None, name=None):
+    #tf.layers.conv3d(strides=kernel_size) of every track at once, kernel (T, kd, kh, kw, C, filters)
+    num_tracks, channels = tracks.get_shape().as_list()[0], tracks.get_shape().as_list()[-1]
+    with tf.variable_scope(name):
+        kernel = tf.get_variable('kernel', [num_tracks] + list(kernel_size) + [channels, filters], initializer=stacked_initializer(tf.glorot_uniform_initializer()))
+        bias = tf.get_variable('bias', [num_tracks, filters], initializer=tf.zeros_initializer())
+    patches, spatial = to_patches(tracks, kernel_size)
+    out = tf.matmul(patches, tf.reshape(kernel, [num_tracks, -1, filters])) + bias[:, tf.newaxis, :]
+    out = tf.reshape(out, [num_tracks, -1] + spatial + [filters])
+    return out if activation is None else activation(out)
+
+def conv3d_transpose_tracks(tracks, filters, kernel_size, activation=None, name=None):
+    #tf.layers.conv3d_transpose(strides=kernel_size) of every track at once, kernel (T, kd, kh, kw, filters, C)
+    num_tracks, batch, depth, height, width, channels = tracks.get_shape().as_list()
+    with tf.variable_scope(name):
+        kernel = tf.get_variable('kernel', [num_tracks] + list(kernel_size) + [filters, channels], initializer=stacked_initializer(tf.glorot_uniform_initializer()))
+        bias = tf.get_variable('bias', [num_tracks, filters], initializer=tf.zeros_initializer())
+    #every input position expands into one kernel sized block of the output
+    weights = tf.reshape(tf.transpose(kernel, [0, 5, 1, 2, 3, 4]), [num_tracks, channels, -1])
+    patches = tf.matmul(tf.reshape(tracks, [num_tracks, -1, channels]), weights)
+    out = from_patches(patches, [depth, height, width], kernel_size, filters) + bias[:, tf.newaxis, tf.newaxis, tf.newaxis, tf.newaxis, :]
+    return out if activation is None else activation(out)
+
+def batch_normalization_tracks(tracks, name=None):
+    #tf.layers.batch_normalization in inference mode (as the per-track layers are called) with per-track parameters
+    num_tracks, channels = tracks.get_shape().as_list()[0], tracks.get_shape().as_list()[-1]
+    with tf.variable_scope(name):
+        gamma = tf.get_variable('gamma', [num_tracks, channels], initializer=tf.ones_initializer())
+        beta = tf.get_variable('beta', [num_tracks, channels], initializer=tf.zeros_initializer())
+        moving_mean = tf.get_variable('moving_mean', [num_tracks, channels], initializer=tf.zeros_initializer(), trainable=False)
+        moving_variance = tf.get_variable('moving_variance', [num_tracks, channels], initializer=tf.ones_initializer(), trainable=False)
+    shape = [num_tracks, 1, 1, 1, 1, channels]
+    return tf.nn.batch_normalization(tracks, tf.reshape(moving_mean, shape), tf.reshape(moving_variance, shape), tf.reshape(beta, shape), tf.reshape(gamma, shape), BN_EPSILON)
+
+
+def generator_private(shared_out, num_tracks):
+    #the private generators of Generator, shared output (B, D, H, W, C) -> (B, 4, 96, 84, num_tracks) before the sigmoid
+    tracks = tf.tile(shared_out[tf.newaxis], [num_tracks, 1, 1, 1, 1, 1])
+    pt = conv3d_transpose_tracks(tracks, 16, (1, 1, 12), my_leaky_relu, 'generator_pt_conv3d_1' + BATCHED_SUFFIX)
+    pt = batch_normalization_tracks(pt, 'generator_pt_bn_1' + BATCHED_SUFFIX)
+    pt = conv3d_transpose_tracks(pt, 8, (1, 6, 1), my_leaky_relu, 'generator_pt_conv3d_2' + BATCHED_SUFFIX)
+    pt = batch_normalization_tracks(pt, 'generator_pt_bn_2' + BATCHED_SUFFIX)
+    tp = conv3d_transpose_tracks(tracks, 16, (1, 6, 1), my_leaky_relu, 'generator_tp_conv3d_1' + BATCHED_SUFFIX)
+    tp = batch_normalization_tracks(tp, 'generator_tp_bn_1' + BATCHED_SUFFIX)
+    tp = conv3d_transpose_tracks(tp, 8, (1, 1, 12), my_leaky_relu, 'generator_tp_conv3d_2' + BATCHED_SUFFIX)
+    tp = batch_normalization_tracks(tp, 'generator_tp_bn_2' + BATCHED_SUFFIX)
+    merged = conv3d_transpose_tracks(tf.concat([pt, tp], -1), 1, (1, 1, 1), None, 'generator_merged_conv3d' + BATCHED_SUFFIX)
+    merged = batch_normalization_tracks(merged, 'generator_merged_bn' + BATCHED_SUFFIX)
+    return merge_tracks(merged)
+
+def critic_private(inputs, num_tracks, model, filters):
+    #the private stacks of Discriminator (model 'discriminator', 32 filters) or Classifier ('classifier', 64 filters)
+    #(B, 4, 96, 84, num_tracks) -> (B, 4, 16, 7, num_tracks*2*filters)
+    tracks = split_tracks(inputs)
+    pt = conv3d_tracks(tracks, filters, (1, 1, 12), my_leaky_relu, model + '_pt_conv3d_1' + BATCHED_SUFFIX)
+    pt = conv3d_tracks(pt, 2*filters, (1, 6, 1), my_leaky_relu, model + '_pt_conv3d_2' + BATCHED_SUFFIX)
+    tp = conv3d_tracks(tracks, filters, (1, 6, 1), my_leaky_relu, model + '_tp_conv3d_1' + BATCHED_SUFFIX)
+    tp = conv3d_tracks(tp, 2*filters, (1, 1, 12), my_leaky_relu, model + '_tp_conv3d_2' + BATCHED_SUFFIX)
+    merged = conv3d_tracks(tf.concat([pt, tp], -1), 2*filters, (1, 1, 1), my_leaky_relu, model + '_merged_conv3d' + BATCHED_SUFFIX)
+    return merge_tracks(merged)
+
+
+def batched_name(name, num_tracks=NUM_TRACKS):
+    #(batched variable name, track) of a per-track private variable (or one of its optimizer slots), (None, None) otherwise
+    components = name.split("/")
+    for ii in range(len(components)):
+        for layer in PRIVATE_LAYERS:
+            for track in range(num_tracks):
+                if components[ii] == layer + str(track):
+                    return "/".join(components[:ii] + [layer + BATCHED_SUFFIX] + components[ii+1:]), track
+    return None, None
+
+def per_track_names(name, num_tracks=NUM_TRACKS):
+    #per-track variable names of a batched private variable in track order, None for any other variable
+    components = name.split("/")
+    for ii in range(len(components)):
+        for layer in PRIVATE_LAYERS:
+            if components[ii] == layer + BATCHED_SUFFIX:
+                return ["/".join(components[:ii] + [layer + str(track)] + components[ii+1:]) for track in range(num_tracks)]
+    return None
+
+def batch_variables(values, num_tracks=NUM_TRACKS):
+    #{name: array} of per-track variables -> the same variables with the private ones stacked under batched names
+    converted = {}
+    stacked = {}
+    for name, value in values.items():
+        batched, track = batched_name(name, num_tracks)
+        if batched is None:
+            converted[name] = value
+        else:
+            stacked.setdefault(batched, {})[track] = value
+    for name, tracks in stacked.items():
+        if sorted(tracks) != list(range(num_tracks)):
+            raise ValueError(name + " only has tracks " + str(sorted(tracks)) + " of " + str(num_tracks))
+        converted[name] = np.stack([tracks[track] for track in range(num_tracks)])
+    return converted
+
+def unbatch_variables(values, num_tracks=NUM_TRACKS):
+    #the inverse of batch_variables
+    converted = {}
+    for name, value in values.items():
+        names = per_track_names(name, num_tracks)
+        if names is None:
+            converted[name] = value
+        else:
+            if len(value) != num_tracks:
+                raise ValueError(name + " stacks " + str(len(value)) + " tracks, expected " + str(num_tracks))
+            converted.update(zip(names, value))
+    return converted
+
+def variables_layout(names, num_tracks=NUM_TRACKS):
+    #'batched' or 'per_track' private layers of a list of variable names, None when it has no private layer variables
+    if any(per_track_names(name, num_tracks) is not None for name in names):
+        return 'batched'
+    if any(batched_name(name, num_tracks)[0] is not None for name in names):
+        return 'per_track'
+    return None
+
+def read_checkpoint(path, to=None, num_tracks=NUM_TRACKS):
+    #{name: array} of every variable of a checkpoint, with the private layers converted to layout to ('batched' or 'per_track') if given
+    reader = tf.train.NewCheckpointReader(path)
+    values = dict((name, reader.get_tensor(name)) for name in reader.get_variable_to_shape_map())
+    if to is None or variables_layout(values, num_tracks) in (None, to):
+        return values
+    return batch_variables(values, num_tracks) if to == 'batched' else unbatch_variables(values, num_tracks)
+
+def write_checkpoint(values, path):
+    #saves {name: array} as a tf.train.Saver checkpoint at path
+    with tf.Graph().as_default():
+        placeholders = dict((name, tf.placeholder(tf.as_dtype(value.dtype), value.shape)) for name, value in values.items())
+        variables = dict((name, tf.Variable(placeholders[name], name="converted_" + str(ii))) for ii, name in enumerate(sorted(values)))
+        saver = tf.train.Saver(variables)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer(), feed_dict=dict((placeholders[name], values[name]) for name in values))
+            saver.save(sess, path, write_meta_graph=False)
+
+def convert_checkpoint(source, destination, to='batched', num_tracks=NUM_TRACKS):
+    #rewrites a checkpoint for BATCHED_TRACKS on ('batched') or off ('per_track'), the training state file is copied along
+    values = read_checkpoint(source, to, num_tracks)
+    os.makedirs(os.path.dirname(abspath(destination)), exist_ok=True)
+    write_checkpoint(values, destination)
+    if exists(source + checkpoints.STATE_SUFFIX):
+        shutil.copyfile(source + checkpoints.STATE_SUFFIX, destination + checkpoints.STATE_SUFFIX)
+
+
+def check_equivalence(batch_size=2, seed=0, tolerance=EQUIVALENCE_TOLERANCE):
+    #largest difference of Generator, Discriminator and Classifier outputs, per-track vs batched on the same weights,
+    #relative to the largest per-track output (at least 1); raises when one is over tolerance
+    from class_conditional_musegan_GAN import Generator, Discriminator, Classifier
+    rng = np.random.RandomState(seed)
+    genres = rng.randint(NUM_CLASSES, size=batch_size)
+    latents = rng.randn(batch_size, LATENT_SIZE).astype(np.float32)
+    phrases = (rng.rand(batch_size, NUM_BARS, BEATS_PER_BAR, NUM_NOTES, NUM_TRACKS) < 0.05).astype(np.float32)
+
+    outputs = {}
+    values = None
+    for batched in [False, True]:
+        with tf.Graph().as_default():
+            input_genre = tf.constant(genres, dtype=tf.int32)
+            latent_vector = tf.constant(latents)
+            real_data = tf.constant(phrases)
+            models = [Generator(input_genre, latent_vector, LATENT_SIZE, NUM_TRACKS, NUM_CLASSES, batched),
+                      Discriminator(real_data, NUM_TRACKS, batched),
+                      Classifier(real_data, NUM_TRACKS, NUM_CLASSES, batched)[0]]
+            with tf.Session() as sess:
+                #random weights, so batch normalization and biases are not at their identity initial values
+                if values is None:
+                    values = dict((variable.op.name, rng.uniform(0.5, 1.5, variable.shape.as_list()) if variable.op.name.endswith("moving_variance") else rng.uniform(-0.5, 0.5, variable.shape.as_list())) for variable in tf.global_variables())
+                    loaded = values
+                else:
+                    loaded = batch_variables(values)
+                for variable in tf.global_variables():
+                    variable.load(loaded[variable.op.name], sess)
+                outputs[batched] = sess.run(models)
+
+    differences = dict((name, float(np.max(np.abs(per_track - batched))/max(1.0, float(np.max(np.abs(per_track))))))
+                       for name, per_track, batched in zip(['Generator', 'Discriminator', 'Classifier'], outputs[False], outputs[True]))
+    over = [name for name in differences if not differences[name] <= tolerance]
+    if over:
+        raise AssertionError("Batched outputs of " + ", ".join(over) + " differ by more than " + str(tolerance) + ": " + str(differences))
+    return differences
+
+
+def parser():
+    parser = argparse.ArgumentParser(description="Checkpoint conversion and equivalence check for BATCHED_TRACKS")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    convert_parser = commands.add_parser('convert', help='convert a checkpoint between per-track and batched private layers')
+    convert_parser.add_argument('source', help='checkpoint path (prefix of its .index file)')
+    convert_parser.add_argument('destination')
+    convert_parser.add_argument('--to', choices=['batched', 'per_track'], default='batched')
+
+    check_parser = commands.add_parser('check', help='compare per-track and batched model outputs on random weights')
+    check_parser.add_argument('-b', '--batch-size', type=int, default=2)
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    args = parser()
+    if args.command == 'convert':
+        convert_checkpoint(abspath(args.source), abspath(args.destination), args.to)
+    else:
+        for name, difference in check_equivalence(args.batch_size).items():
+            print(name + " max relative difference: " + str(difference) + " (tolerance " + str(EQUIVALENCE_TOLERANCE) + ")")
+
+if __name__ == '__main__':
+    main()